@@ -0,0 +1,103 @@
+'''
+#########################################################
+Micro-benchmark of the arrangement of prediction patches into batches
+(Loader.arange_patches_single) and of the inverse reshaping of the model
+output (Loader.batch_output_to_array), as run by mpi_make_predictions for
+every batch of pred_batch_size shots. Compares the legacy double loops with
+the vectorized Loader methods, on 128 shots padded to 6000 timesteps with
+14 signals, pred_length 200 and float32 data
+#########################################################
+'''
+from __future__ import print_function
+import timeit
+
+import numpy as np
+
+from plasma.models.loader import Loader
+
+
+def legacy_arange_patches_single(sig_patches, res_patches, num_timesteps):
+    batch_size = len(sig_patches)
+    num_chunks = len(sig_patches[0]) // num_timesteps
+    num_dimensions_of_data = sig_patches[0].shape[1]
+    num_answers = res_patches[0].shape[1]
+    X = np.zeros((num_chunks*batch_size, num_timesteps,
+                  num_dimensions_of_data))
+    y = np.zeros((num_chunks*batch_size, num_timesteps, num_answers))
+    for chunk_idx in range(num_chunks):
+        src_start = chunk_idx*num_timesteps
+        src_end = (chunk_idx+1)*num_timesteps
+        for patch_idx in range(batch_size):
+            X[chunk_idx*batch_size + patch_idx, :,
+                :] = sig_patches[patch_idx][src_start:src_end]
+            y[chunk_idx*batch_size + patch_idx, :,
+                :] = res_patches[patch_idx][src_start:src_end]
+    return X, y
+
+
+def legacy_batch_output_to_array(output, batch_size):
+    num_chunks = output.shape[0] // batch_size
+    num_timesteps = output.shape[1]
+    feature_size = output.shape[2]
+    outs = []
+    for patch_idx in range(batch_size):
+        out = np.empty((num_chunks*num_timesteps, feature_size))
+        for chunk in range(num_chunks):
+            out[chunk*num_timesteps:(chunk + 1)*num_timesteps, :] = output[
+                chunk * batch_size + patch_idx, :, :]
+        outs.append(out)
+    return outs
+
+
+if __name__ == '__main__':
+    pred_batch_size = 128
+    pred_length = 200
+    shot_length = 6000
+    num_signals = 14
+    number = 5
+    conf = {'data': {'floatx': 'float32'},
+            'model': {'pred_length': pred_length,
+                      'pred_batch_size': pred_batch_size,
+                      'return_sequences': True, 'stateful': True},
+            'paths': {'processed_prepath': ''}}
+    loader = Loader(conf)
+    rng = np.random.RandomState(0)
+    sig_patches = [rng.randn(shot_length, num_signals).astype('float32')
+                   for _ in range(pred_batch_size)]
+    res_patches = [rng.randn(shot_length, 1).astype('float32')
+                   for _ in range(pred_batch_size)]
+
+    X_legacy, y_legacy = legacy_arange_patches_single(
+        sig_patches, res_patches, pred_length)
+    X, y = loader.arange_patches_single(sig_patches, res_patches,
+                                        prediction_mode=True)
+    assert X.dtype == np.float32 and np.array_equal(X, X_legacy)
+    assert y.dtype == np.float32 and np.array_equal(y, y_legacy)
+    for a, b in zip(legacy_batch_output_to_array(y, pred_batch_size),
+                    loader.batch_output_to_array(y)):
+        assert np.array_equal(a, b)
+
+    t_arange_legacy = min(timeit.repeat(
+        lambda: legacy_arange_patches_single(sig_patches, res_patches,
+                                             pred_length),
+        number=number, repeat=3))/number
+    t_arange = min(timeit.repeat(
+        lambda: loader.arange_patches_single(sig_patches, res_patches,
+                                             prediction_mode=True),
+        number=number, repeat=3))/number
+    t_output_legacy = min(timeit.repeat(
+        lambda: legacy_batch_output_to_array(y, pred_batch_size),
+        number=number, repeat=3))/number
+    t_output = min(timeit.repeat(
+        lambda: loader.batch_output_to_array(y),
+        number=number, repeat=3))/number
+    print('{} shots x {} timesteps x {} signals, pred_length {}'.format(
+        pred_batch_size, shot_length, num_signals, pred_length))
+    print('arange_patches_single legacy    : {:.2f} ms'.format(
+        1e3*t_arange_legacy))
+    print('arange_patches_single vectorized: {:.2f} ms ({:.1f}x)'.format(
+        1e3*t_arange, t_arange_legacy/t_arange))
+    print('batch_output_to_array legacy    : {:.2f} ms'.format(
+        1e3*t_output_legacy))
+    print('batch_output_to_array vectorized: {:.2f} ms ({:.1f}x)'.format(
+        1e3*t_output, t_output_legacy/t_output))
@@ -0,0 +1,81 @@
+'''
+#########################################################
+Micro-benchmark of the shot resampling step of preprocessing on a synthetic
+shot with 64 signals (48 scalar signals sharing a time base, 16 profile
+signals with 32 channels each). Compares the legacy per-column resampling
+with the batched, vectorized plasma.utils.processing.cut_and_resample_signals
+#########################################################
+'''
+from __future__ import print_function
+import timeit
+
+import numpy as np
+
+from plasma.utils.processing import (
+    cut_and_resample_signals, cut_signal, time_sensitive_interp
+    )
+
+
+def legacy_cut_and_resample_signal(t, sig, tmin, tmax, dt, precision_str):
+    t, sig = cut_signal(t, sig, tmin, tmax)
+    order = np.argsort(t)
+    t = t[order]
+    sig = sig[order, :]
+    sig_width = sig.shape[1]
+    tt = np.arange(tmin, tmax, dt, dtype=precision_str)
+    sig_interp = np.zeros((len(tt), sig_width), dtype=precision_str)
+    for i in range(sig_width):
+        sig_interp[:, i] = time_sensitive_interp(sig[:, i], t, tt)
+    return tt, sig_interp
+
+
+def make_synthetic_shot(num_scalar=48, num_profile=16, num_channels=32,
+                        duration=6.0, seed=0):
+    rng = np.random.RandomState(seed)
+    time_arrays = []
+    signal_arrays = []
+    # scalar signals sampled at ~10 kHz on a common time base
+    t_scalar = np.unique(rng.uniform(0, duration, int(duration*1e4)).astype(
+        'float32'))
+    for _ in range(num_scalar):
+        time_arrays.append(t_scalar)
+        signal_arrays.append(rng.randn(len(t_scalar), 1).astype('float32'))
+    # profile signals sampled at ~1 kHz, each on its own time base
+    for _ in range(num_profile):
+        t = np.unique(rng.uniform(0, duration, int(duration*1e3)).astype(
+            'float32'))
+        time_arrays.append(t)
+        signal_arrays.append(
+            rng.randn(len(t), num_channels).astype('float32'))
+    t_min = max([t.min() for t in time_arrays])
+    t_max = min([t.max() for t in time_arrays])
+    return time_arrays, signal_arrays, t_min, t_max
+
+
+def run_legacy(time_arrays, signal_arrays, t_min, t_max, dt):
+    return [legacy_cut_and_resample_signal(t, s, t_min, t_max, dt,
+                                           'float32')[1]
+            for t, s in zip(time_arrays, signal_arrays)]
+
+
+def run_batched(time_arrays, signal_arrays, t_min, t_max, dt):
+    return cut_and_resample_signals(time_arrays, signal_arrays, t_min, t_max,
+                                    dt, 'float32')[1]
+
+
+if __name__ == '__main__':
+    dt = 0.001
+    number = 20
+    time_arrays, signal_arrays, t_min, t_max = make_synthetic_shot()
+    args = (time_arrays, signal_arrays, t_min, t_max, dt)
+    for a, b in zip(run_legacy(*args), run_batched(*args)):
+        assert np.array_equal(a, b)
+    t_legacy = min(timeit.repeat(lambda: run_legacy(*args), number=number,
+                                 repeat=3))/number
+    t_batched = min(timeit.repeat(lambda: run_batched(*args), number=number,
+                                  repeat=3))/number
+    print('{} signals, {} resampled timesteps'.format(
+        len(signal_arrays), int((t_max - t_min)/dt)))
+    print('legacy : {:.2f} ms/shot'.format(1e3*t_legacy))
+    print('batched: {:.2f} ms/shot ({:.1f}x)'.format(1e3*t_batched,
+                                                     t_legacy/t_batched))
@@ -0,0 +1,51 @@
+'''
+#########################################################
+Micro-benchmark of the causal exponential smoothing applied by the
+AveragingVarNormalizer, on a synthetic shot with 2000 timesteps and 100
+channels. Compares the legacy per-channel scipy.signal.correlate with the
+vectorized plasma.utils.processing.correlate_valid
+#########################################################
+'''
+from __future__ import print_function
+import timeit
+
+import numpy as np
+from scipy.signal import correlate
+try:
+    from scipy.signal import exponential
+except ImportError:
+    from scipy.signal.windows import exponential
+
+from plasma.utils.processing import correlate_valid
+
+
+def legacy_smooth(signal_array, window):
+    return np.apply_along_axis(lambda m: correlate(m, window, 'valid'),
+                               axis=0, arr=signal_array)
+
+
+if __name__ == '__main__':
+    num_steps = 2000
+    num_channels = 100
+    window_size = 10
+    window_decay = 2
+    number = 20
+    window = exponential(window_size, 0, window_decay, False)
+    window /= np.sum(window)
+    signal_array = np.random.RandomState(0).randn(
+        num_steps, num_channels).astype('float32')
+    expected = legacy_smooth(signal_array, window)
+    result = correlate_valid(signal_array, window)
+    assert result.shape == expected.shape
+    assert result.dtype == expected.dtype
+    assert np.allclose(result, expected, rtol=1e-12, atol=1e-12)
+    t_legacy = min(timeit.repeat(lambda: legacy_smooth(signal_array, window),
+                                 number=number, repeat=3))/number
+    t_vector = min(timeit.repeat(
+        lambda: correlate_valid(signal_array, window), number=number,
+        repeat=3))/number
+    print('{} timesteps, {} channels, window size {}'.format(
+        num_steps, num_channels, window_size))
+    print('legacy    : {:.3f} ms/shot'.format(1e3*t_legacy))
+    print('vectorized: {:.3f} ms/shot ({:.1f}x)'.format(1e3*t_vector,
+                                                        t_legacy/t_vector))
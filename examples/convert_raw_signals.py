@@ -0,0 +1,27 @@
+'''
+#########################################################
+Migrate the raw signal .txt files under signal_prepath to the binary .npy
+format read by Signal.load_data(). Both formats are read transparently, so
+the conversion can be run on a live data tree; pass --remove_txt to delete
+the text files once they are converted.
+#########################################################
+'''
+from __future__ import print_function
+import argparse
+
+from plasma.conf import conf
+from plasma.utils.downloading import convert_raw_signal_tree
+
+parser = argparse.ArgumentParser(prog='convert_raw_signals')
+parser.add_argument("--num_processes", "-n", type=int, default=None,
+                    help="number of worker processes (default: #cores - 2)")
+parser.add_argument("--remove_txt", action="store_true",
+                    help="delete each .txt file after it has been converted")
+args = parser.parse_args()
+
+signal_prepaths = conf['paths']['signal_prepath']
+if not isinstance(signal_prepaths, list):
+    signal_prepaths = [signal_prepaths]
+for prepath in signal_prepaths:
+    convert_raw_signal_tree(prepath, num_processes=args.num_processes,
+                            remove_txt=args.remove_txt)
@@ -82,15 +82,16 @@ if only_predict:
 #                   PREPROCESSING                   #
 #####################################################
 # TODO(KGF): check tuple unpack
+# normalizer stats are extracted during preprocessing if not saved yet
+nn = Normalizer(conf)
 (shot_list_train, shot_list_validate,
- shot_list_test) = guarantee_preprocessed(conf)
+ shot_list_test) = guarantee_preprocessed(conf, normalizer=nn)
 
 #####################################################
 #                   NORMALIZATION                   #
 #####################################################
 
 print("normalization", end='')
-nn = Normalizer(conf)
 nn.train()
 loader = Loader(conf, nn)
 print("...done")
@@ -86,7 +86,7 @@ if task_index == 0:
      shot_list_test) = guarantee_preprocessed(conf)
 comm.Barrier()
 (shot_list_train, shot_list_validate,
- shot_list_test) = guarantee_preprocessed(conf)
+ shot_list_test) = guarantee_preprocessed(conf, update=False)
 
 
 print("normalization", end='')
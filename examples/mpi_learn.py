@@ -96,21 +96,25 @@ if only_predict:
 #                 NORMALIZATION                     #
 #####################################################
 normalizer = Normalizer(conf)
-if g.task_index == 0:
-    # make sure preprocessing has been run, and results are saved to files
-    # if not, only master MPI rank spawns thread pool to perform preprocessing
-    (shot_list_train, shot_list_validate,
-     shot_list_test) = guarantee_preprocessed(conf)
-    # similarly, train normalizer (if necessary) w/ master MPI rank only
-    normalizer.train()  # verbose=False only suppresses if purely loading
-g.comm.Barrier()
+# make sure preprocessing has been run, and results are saved to files
+# if not, the shots are sharded across all MPI ranks, each of which spawns a
+# local process pool to perform its share of the preprocessing. The
+# normalizer stats are extracted in the same pass if they are not saved yet
+(shot_list_train, shot_list_validate,
+ shot_list_test) = guarantee_preprocessed(conf, distributed=True,
+                                          normalizer=normalizer)
+# train normalizer (if still necessary): the picked shots are sharded across
+# all MPI ranks and the partial stats are merged and saved by the master rank
+normalizer.train(distributed=True)  # verbose=False only suppresses if loading
 g.print_unique("begin preprocessor+normalization (all MPI ranks)...")
 # second call has ALL MPI ranks load preprocessed shots from .npz files
+# (without updating them again in incremental mode)
 (shot_list_train, shot_list_validate,
- shot_list_test) = guarantee_preprocessed(conf, verbose=True)
+ shot_list_test) = guarantee_preprocessed(conf, verbose=True,
+                                          distributed=True, update=False)
 # second call to normalizer training
 normalizer.conf['data']['recompute_normalization'] = False
-normalizer.train(verbose=True)
+normalizer.train(verbose=True, distributed=True)
 # KGF: may want to set it back...
 # normalizer.conf['data']['recompute_normalization'] = conf['data']['recompute_normalization']   # noqa
 loader = Loader(conf, normalizer)
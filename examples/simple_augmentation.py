@@ -91,7 +91,7 @@ if task_index == 0:
      shot_list_test) = guarantee_preprocessed(conf)
 comm.Barrier()
 (shot_list_train, shot_list_validate,
- shot_list_test) = guarantee_preprocessed(conf)
+ shot_list_test) = guarantee_preprocessed(conf, update=False)
 
 
 def chunks(l, n):
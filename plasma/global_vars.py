@@ -21,6 +21,17 @@ def init_MPI():
     num_workers = comm.Get_size()
 
 
+def get_local_size():
+    '''Number of MPI ranks sharing this node (1 for non-MPI runs)'''
+    if comm is None:
+        return 1
+    from mpi4py import MPI
+    local_comm = comm.Split_type(MPI.COMM_TYPE_SHARED)
+    local_size = local_comm.Get_size()
+    local_comm.Free()
+    return local_size
+
+
 def init_GPU_backend(conf):
     global NUM_GPUS, MY_GPU, backend
     NUM_GPUS = conf['num_gpus']
@@ -9,10 +9,16 @@ This work was supported by the DOE CSGF program.
 '''
 
 from __future__ import print_function, division
+import random
+import traceback
+from functools import partial
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 
-from plasma.primitives.shots import Shot
+from plasma.primitives.shots import Shot, ShotMetadataIndex
+from plasma.primitives.dataset import ShotDataset
 import multiprocessing as mp
+import queue
 
 # import pdb
 
@@ -40,6 +46,22 @@ class Loader(object):
         self.stateful = conf['model']['stateful']
         self.normalizer = normalizer
         self.verbose = True
+        self.dataset = None
+        if ShotDataset.is_enabled(conf):
+            dataset_prepath = ShotDataset.get_prepath(conf)
+            if ShotDataset.previously_saved(dataset_prepath):
+                self.dataset = ShotDataset(dataset_prepath)
+            else:
+                print('Warning, no consolidated dataset at {}. '.format(
+                    dataset_prepath), 'Restoring individual shot files')
+
+    def restore_shot(self, shot):
+        '''Restore a shot from the consolidated dataset when available,
+        otherwise from its individual processed shot file'''
+        if self.dataset is not None and shot in self.dataset:
+            self.dataset.restore(shot)
+        else:
+            shot.restore(self.conf['paths']['processed_prepath'])
 
     def set_inference_mode(self, val):
         self.normalizer.set_inference_mode(val)
@@ -107,8 +129,7 @@ class Loader(object):
                         num_so_far, num_total
             epoch += 1
 
-    def fill_training_buffer(self, Xbuff, Ybuff, end_indices, shot,
-                             is_first_fill=False):
+    def fill_training_buffer(self, buff, shot, is_first_fill=False):
         sig, res = self.get_signal_result_from_shot(shot)
         length = self.conf['model']['length']
         if is_first_fill:  # cut signal to random position
@@ -122,29 +143,19 @@ class Loader(object):
         sig_len = res.shape[0]
         sig_len = (sig_len // length)*length  # make divisible by lenth
         assert sig_len > 0
-        batch_idx = np.where(end_indices == 0)[0][0]
-        if sig_len > Xbuff.shape[1]:
-            Xbuff = self.resize_buffer(Xbuff, sig_len+length)
-            Ybuff = self.resize_buffer(Ybuff, sig_len+length)
-        Xbuff[batch_idx, :sig_len, :] = sig[-sig_len:]
-        Ybuff[batch_idx, :sig_len, :] = res[-sig_len:]
-        end_indices[batch_idx] += sig_len
+        batch_idx = buff.get_empty_rows()[0]
+        buff.append(batch_idx, sig[-sig_len:], res[-sig_len:])
         # print("Filling buffer at index {}".format(batch_idx))
-        return Xbuff, Ybuff, batch_idx
-
-    def return_from_training_buffer(self, Xbuff, Ybuff, end_indices):
-        length = self.conf['model']['length']
-        end_indices -= length
-        assert np.all(end_indices >= 0)
-        X = 1.0*Xbuff[:, :length, :]
-        Y = 1.0*Ybuff[:, :length, :]
-        self.shift_buffer(Xbuff, length)
-        self.shift_buffer(Ybuff, length)
+        return batch_idx
+
+    def return_from_training_buffer(self, buff, copy=True):
+        '''Next batch of buff, as copies unless copy=False, in which case
+        the arrays are overwritten by the next call'''
+        X, Y = buff.next_batch()
+        if copy:
+            return X.copy(), Y.copy()
         return X, Y
 
-    def shift_buffer(self, buff, length):
-        buff[:, :-length, :] = buff[:, length:, :]
-
     def resize_buffer(self, buff, new_length, dtype=None):
         if dtype is None:
             dtype = self.conf['data']['floatx']
@@ -156,7 +167,7 @@ class Loader(object):
         # print("Resizing buffer to new length {}".format(new_length))
         return new_buff
 
-    def inference_batch_generator_full_shot(self, shot_list):
+    def inference_batch_generator_full_shot(self, shot_list, bucketed=False):
         """
         The method implements a training batch generator as a Python generator
         with a while-loop.
@@ -178,6 +189,12 @@ class Loader(object):
             during stateful RNN training
           - num_so_far,num_total: number of samples generated so far and
             the total dataset size as per shot_list
+
+        With bucketed=True, the shots are batched in order of decreasing
+        length (see get_length_buckets), each batch is only padded to its
+        longest shot, and the positions in shot_list of the shots of the
+        batch are yielded as an additional last element, to restore the
+        original order of the outputs.
         """
         batch_size = self.conf['model']['pred_batch_size']
         sig, res = self.get_signal_result_from_shot(shot_list.shots[0])
@@ -195,6 +212,11 @@ class Loader(object):
         #  returned = False
         #  num_steps = 0
         batch_idx = 0
+        shot_indices = np.arange(num_total)
+        if bucketed:
+            shot_indices = np.concatenate(self.get_length_buckets(
+                self.get_shot_lengths(shot_list), batch_size))
+        indices = np.zeros(batch_size, dtype=int)
         np.seterr(all='raise')
         # warmup_steps = self.conf['training']['batch_generator_warmup_steps']
         # is_warmup_period = num_steps < warmup_steps
@@ -202,7 +224,7 @@ class Loader(object):
         while True:
             # the list of all shots
             # shot_list.shuffle()
-            for i in range(num_total):
+            for i in shot_indices:
                 shot = shot_list.shots[i]
                 sig, res = self.get_signal_result_from_shot(shot)
                 sig_len = res.shape[0]
@@ -221,16 +243,25 @@ class Loader(object):
                 Maskbuff[batch_idx, :sig_len, :] = 1.0
                 disr[batch_idx] = shot.is_disruptive_shot()
                 lengths[batch_idx] = res.shape[0]
+                indices[batch_idx] = i
                 batch_idx += 1
                 if batch_idx == batch_size:
                     num_so_far += batch_size
-                    x1 = 1.0*Xbuff
-                    x2 = 1.0*Ybuff
-                    x3 = 1.0*Maskbuff
-                    x4 = disr & True
-                    x5 = 1*lengths
+                    if bucketed:
+                        max_len = np.max(lengths)
+                        x1 = 1.0*Xbuff[:, :max_len, :]
+                        x2 = 1.0*Ybuff[:, :max_len, :]
+                        x3 = 1.0*Maskbuff[:, :max_len, :]
+                        yield (x1, x2, x3, disr & True, 1*lengths, num_so_far,
+                               num_total, 1*indices)
+                    else:
+                        x1 = 1.0*Xbuff
+                        x2 = 1.0*Ybuff
+                        x3 = 1.0*Maskbuff
+                        x4 = disr & True
+                        x5 = 1*lengths
 
-                    yield x1, x2, x3, x4, x5, num_so_far, num_total
+                        yield x1, x2, x3, x4, x5, num_so_far, num_total
                     batch_idx = 0
 
     def training_batch_generator_full_shot_partial_reset(self, shot_list):
@@ -307,7 +338,8 @@ class Loader(object):
             shot = shot_list.sample_weighted()
         return shot
 
-    def training_batch_generator_partial_reset(self, shot_list):
+    def training_batch_generator_partial_reset(self, shot_list,
+                                               copy_batches=True):
         """
         The method implements a training batch generator as a Python generator
         with a while-loop. It iterates indefinitely over the data set and
@@ -326,16 +358,23 @@ class Loader(object):
         during stateful RNN training
           - num_so_far,num_total: number of samples generated so far and the
         total dataset size as per shot_list
+
+        With copy_batches=False, X and y are the preallocated output arrays
+        of the TrainingBuffer, overwritten by the next batch, so a batch
+        must not be kept across next() calls (e.g. when the batches are
+        copied right away, as by PrefetchGenerator).
         """
         batch_size = self.conf['training']['batch_size']
-        # length = self.conf['model']['length']
+        length = self.conf['model']['length']
         sig, res = self.get_signal_result_from_shot(shot_list.shots[0])
-        Xbuff = np.empty((batch_size,) + sig.shape,
-                         dtype=self.conf['data']['floatx'])
-        Ybuff = np.empty((batch_size,) + res.shape,
-                         dtype=self.conf['data']['floatx'])
-        end_indices = np.zeros(batch_size, dtype=np.int)
-        batches_to_reset = np.ones(batch_size, dtype=np.bool)
+        max_buffer_length = None
+        if ('max_buffer_length' in self.conf['training']
+                and self.conf['training']['max_buffer_length']):
+            max_buffer_length = self.conf['training']['max_buffer_length']
+        buff = TrainingBuffer(batch_size, length, sig.shape[1], res.shape[1],
+                              sig.shape[0], self.conf['data']['floatx'],
+                              max_buffer_length)
+        batches_to_reset = np.ones(batch_size, dtype=bool)
         # epoch = 0
         num_total = len(shot_list)
         num_so_far = 0
@@ -359,9 +398,9 @@ class Loader(object):
                         # shot = shot_list.shots[i]
                 else:  # draw the shot weighted
                     shot = shot_list.sample_weighted()
-                while not np.any(end_indices == 0):
+                while len(buff.get_empty_rows()) == 0:
                     X, Y = self.return_from_training_buffer(
-                        Xbuff, Ybuff, end_indices)
+                        buff, copy_batches)
                     yield (X, Y, batches_to_reset, num_so_far, num_total,
                            is_warmup_period)
                     returned = True
@@ -370,29 +409,38 @@ class Loader(object):
                     is_first_fill = num_steps < batch_size
                     batches_to_reset[:] = False
 
-                Xbuff, Ybuff, batch_idx = self.fill_training_buffer(
-                    Xbuff, Ybuff, end_indices, shot, is_first_fill)
+                batch_idx = self.fill_training_buffer(buff, shot,
+                                                      is_first_fill)
                 batches_to_reset[batch_idx] = True
                 if returned and not is_warmup_period:
                     num_so_far += 1
             # epoch += 1
 
-    def fill_batch_queue(self, shot_list, queue):
-        print("Starting thread to fill queue")
-        gen = self.training_batch_generator_partial_reset(shot_list)
-        while True:
-            ret = next(gen)
-            queue.put(ret, block=True, timeout=-1)
-
-    def training_batch_generator_process(self, shot_list):
-        queue = mp.Queue()
-        proc = mp.Process(target=self.fill_batch_queue,
-                          args=(shot_list, queue))
-        proc.start()
-        while True:
-            yield queue.get(True)
-        proc.join()
-        queue.close()
+    def training_batch_generator_process(self, shot_list,
+                                         generator_func=None, **kwargs):
+        '''Prefetch the batches of a training generator (by default
+        training_batch_generator_partial_reset) in a separate process, see
+        PrefetchGenerator for the keyword arguments'''
+        if generator_func is None:
+            # the batches are copied into the shared slots anyway
+            generator_func = partial(
+                self.training_batch_generator_partial_reset,
+                copy_batches=False)
+            if kwargs.get('slot_nbytes') is None:
+                kwargs['slot_nbytes'] = self.get_training_batch_nbytes()
+        return PrefetchGenerator(partial(generator_func, shot_list),
+                                 **kwargs)
+
+    def get_training_batch_nbytes(self):
+        '''Size of the arrays of a batch of
+        training_batch_generator_partial_reset, from the conf'''
+        batch_size = self.conf['training']['batch_size']
+        length = self.conf['model']['length']
+        num_signals = sum([sig.num_channels
+                           for sig in self.conf['paths']['use_signals']])
+        itemsize = np.dtype(self.conf['data']['floatx']).itemsize
+        # X, Y (one target per timestep) and the bool batches_to_reset
+        return batch_size*(length*(num_signals + 1)*itemsize + 1)
 
     def load_as_X_y_list(self, shot_list, prediction_mode=False):
         """
@@ -433,6 +481,43 @@ class Loader(object):
                 len(res_patches[0]), len(res_patches)))
         return X_list, y_list
 
+    def get_shot_lengths(self, shot_list):
+        '''Processed lengths of the shots, read from the consolidated
+        dataset or the shot metadata index without loading the shots.
+        Shots that are in neither are restored from their files'''
+        prepath = self.conf['paths']['processed_prepath']
+        metadata = None
+        lengths = []
+        for shot in shot_list:
+            length = None
+            if self.dataset is not None and shot in self.dataset:
+                length = self.dataset.lengths[self.dataset.get_shot_row(shot)]
+            else:
+                if metadata is None:
+                    metadata = ShotMetadataIndex(prepath)
+                length = metadata.get_length(shot)
+            if length is None:
+                length = shot.num_timesteps(prepath)
+            lengths.append(int(length))
+        return np.array(lengths, dtype=np.int64)
+
+    @staticmethod
+    def get_length_buckets(lengths, batch_size):
+        '''Group the indices of shots of similar length into batches.
+
+        The shots are sorted by decreasing length (ties in their original
+        order) and split into batches of batch_size. The last batch is
+        filled up with copies of its shortest shot, which do not increase
+        the length it is padded to.
+        '''
+        order = np.argsort(-np.asarray(lengths), kind='stable')
+        buckets = []
+        for i in range(0, len(order), batch_size):
+            bucket = list(order[i:i + batch_size])
+            bucket += [bucket[-1]]*(batch_size - len(bucket))
+            buckets.append(np.array(bucket, dtype=np.int64))
+        return buckets
+
     def load_as_X_y_pred(self, shot_list, custom_batch_size=None):
         (signals, results, shot_lengths,
          disruptive) = self.get_signals_results_from_shotlist(
@@ -446,7 +531,6 @@ class Loader(object):
 
     def get_signals_results_from_shotlist(self, shot_list,
                                           prediction_mode=False):
-        prepath = self.conf['paths']['processed_prepath']
         use_signals = self.conf['paths']['use_signals']
         signals = []
         results = []
@@ -456,7 +540,7 @@ class Loader(object):
         for shot in shot_list:
             assert isinstance(shot, Shot)
             assert shot.valid
-            shot.restore(prepath)
+            self.restore_shot(shot)
 
             if self.normalizer is not None:
                 self.normalizer.apply(shot)
@@ -488,11 +572,10 @@ class Loader(object):
             return signals, results, shot_lengths, disruptive
 
     def get_signal_result_from_shot(self, shot, prediction_mode=False):
-        prepath = self.conf['paths']['processed_prepath']
         use_signals = self.conf['paths']['use_signals']
         assert isinstance(shot, Shot)
         assert shot.valid
-        shot.restore(prepath)
+        self.restore_shot(shot)
         if self.normalizer is not None:
             self.normalizer.apply(shot)
         else:
@@ -526,14 +609,12 @@ class Loader(object):
         num_timesteps = output.shape[1]
         feature_size = output.shape[2]
 
-        outs = []
-        for patch_idx in range(batch_size):
-            out = np.empty((num_chunks*num_timesteps, feature_size))
-            for chunk in range(num_chunks):
-                out[chunk*num_timesteps:(chunk + 1)*num_timesteps, :] = output[
-                    chunk * batch_size + patch_idx, :, :]
-            outs.append(out)
-        return outs
+        # output[chunk*batch_size + patch_idx] -> outs[patch_idx][chunk]
+        outs = np.ascontiguousarray(np.reshape(
+            output, (num_chunks, batch_size, num_timesteps, feature_size)
+            ).transpose(1, 0, 2, 3)).reshape(
+                batch_size, num_chunks*num_timesteps, feature_size)
+        return list(outs)
 
     def make_deterministic_patches(self, signals, results):
         num_timesteps = self.conf['model']['length']
@@ -707,41 +788,40 @@ class Loader(object):
         else:
             num_answers = res_patches[0].shape[1]
 
-        X = np.zeros((num_chunks*batch_size, num_timesteps,
-                      num_dimensions_of_data))
+        # X[chunk_idx*batch_size + patch_idx] is chunk chunk_idx of patch
+        # patch_idx; the chunks of all patches are stacked in a single copy
+        dtype = self.conf['data']['floatx']
+        X = np.empty((num_chunks, batch_size, num_timesteps,
+                      num_dimensions_of_data), dtype=dtype)
+        np.stack([np.reshape(sig, (num_chunks, num_timesteps,
+                                   num_dimensions_of_data))
+                  for sig in sig_patches], axis=1, out=X)
+        res_chunks = [np.reshape(res, (num_chunks, num_timesteps,
+                                       num_answers)) for res in res_patches]
         if return_sequences:
-            y = np.zeros((num_chunks*batch_size, num_timesteps, num_answers))
+            y = np.empty((num_chunks, batch_size, num_timesteps, num_answers),
+                         dtype=dtype)
+            np.stack(res_chunks, axis=1, out=y)
         else:
-            y = np.zeros((num_chunks*batch_size, num_answers))
-
-        for chunk_idx in range(num_chunks):
-            src_start = chunk_idx*num_timesteps
-            src_end = (chunk_idx+1)*num_timesteps
-            for patch_idx in range(batch_size):
-                X[chunk_idx*batch_size + patch_idx, :,
-                    :] = sig_patches[patch_idx][src_start:src_end]
-                if return_sequences:
-                    y[chunk_idx*batch_size + patch_idx, :,
-                        :] = res_patches[patch_idx][src_start:src_end]
-                else:
-                    y[chunk_idx*batch_size + patch_idx,
-                        :] = res_patches[patch_idx][src_end-1]
+            y = np.empty((num_chunks, batch_size, num_answers), dtype=dtype)
+            np.stack([res[:, -1, :] for res in res_chunks], axis=1, out=y)
+        X = X.reshape((num_chunks*batch_size,) + X.shape[2:])
+        y = y.reshape((num_chunks*batch_size,) + y.shape[2:])
         return X, y
 
     def load_as_X_y(self, shot, prediction_mode=False):
         assert isinstance(shot, Shot)
         assert shot.valid
-        prepath = self.conf['paths']['processed_prepath']
         return_sequences = self.conf['model']['return_sequences']
-        shot.restore(prepath)
+        self.restore_shot(shot)
 
         if self.normalizer is not None:
             self.normalizer.apply(shot)
         else:
             print('Warning, no normalization. ',
                   'Training data may be poorly conditioned')
-        signals = shot.signals
-        ttd = shot.ttd
+        ttd, signals = shot.get_data_arrays(
+            self.conf['paths']['use_signals'], self.conf['data']['floatx'])
 
         if self.conf['training']['use_mock_data']:
             signals, ttd = self.get_mock_data()
@@ -790,33 +870,44 @@ class Loader(object):
         arr = arr[-num_chunks*num_timesteps:]
         res = res[-num_chunks*num_timesteps:]
         assert np.shape(arr)[0] == np.shape(res)[0]
-        X = []
-        y = []
-        i = 0
 
         chunk_range = range(num_chunks-1)
         i_range = range(1, num_timesteps+1, skip)
         if prediction_mode:
             chunk_range = range(num_chunks)
             i_range = range(1)
-
-        for chunk in chunk_range:
-            for i in i_range:
-                start = chunk*num_timesteps + i
-                assert start + num_timesteps <= len(arr)
-                X.append(arr[start:start+num_timesteps, :])
-                if return_sequences:
-                    y.append(res[start:start+num_timesteps])
-                else:
-                    y.append(res[start+num_timesteps-1:start+num_timesteps])
-        X = np.array(X)
-        y = np.array(y)
-        if len(np.shape(X)) == 1:
-            X = np.expand_dims(X, axis=len(np.shape(X)))
+        starts = np.array([chunk*num_timesteps + i for chunk in chunk_range
+                           for i in i_range], dtype=np.int64)
+        assert len(starts) == 0 or starts[-1] + num_timesteps <= len(arr)
+
+        X = Loader.get_sliding_windows(np.asarray(arr), num_timesteps, starts)
+        y = Loader.get_sliding_windows(np.asarray(res), num_timesteps, starts)
+        if not return_sequences:
+            y = y[:, num_timesteps-1:num_timesteps]
         if return_sequences:
             y = np.expand_dims(y, axis=len(np.shape(y)))
         return X, y
 
+    @staticmethod
+    def get_sliding_windows(arr, length, starts):
+        '''Stack the windows arr[start:start + length] for all starts.
+
+        The windows are a read-only, zero-copy strided view into arr when
+        the starts are evenly spaced (e.g. skip divides length, or in
+        prediction mode); otherwise they are gathered into a new array.
+        '''
+        num_windows = max(0, arr.shape[0] - length + 1)
+        windows = as_strided(
+            arr, shape=(num_windows, length) + arr.shape[1:],
+            strides=(arr.strides[0],) + arr.strides, writeable=False)
+        if len(starts) == 0:
+            return windows[:0]
+        steps = np.diff(starts)
+        if len(steps) == 0 or (steps[0] > 0 and np.all(steps == steps[0])):
+            step = steps[0] if len(steps) > 0 else 1
+            return windows[starts[0]:starts[-1] + 1:step]
+        return windows[starts]
+
     @staticmethod
     def get_batch_size(batch_size, prediction_mode):
         if prediction_mode:
@@ -829,26 +920,280 @@ class Loader(object):
         return 1 + (length-1)//skip
 
 
-class ProcessGenerator(object):
-    def __init__(self, generator):
-        self.generator = generator
-        self.proc = mp.Process(target=self.fill_batch_queue)
-        self.queue = mp.Queue()
-        self.proc.start()
+class TrainingBuffer(object):
+    '''Per-row ring buffers of timesteps for the partial reset generator.
 
-    def fill_batch_queue(self):
-        print("Starting process to fetch data")
-        count = 0
-        while True:
-            self.queue.put(next(self.generator), True)
-            count += 1
+    Row i holds the unread timesteps of the shot(s) assigned to index i of
+    the batch: num_unread[i] of them, starting at the read cursor start[i]
+    and wrapping around the end of the row. Every step gathers the next
+    length timesteps of all rows into preallocated output arrays with one
+    np.take per array and advances the cursors, so it costs time
+    proportional to the batch, independent of the length of the buffer.
+    The output arrays are overwritten at the next step.
+
+    Rows grow to fit the longest shot, unless max_buffer_length is set: a
+    shot that does not fit is then streamed into its row in segments as
+    the row is read, so the buffers never exceed max_buffer_length
+    timesteps per row (rounded down to a multiple of length). Only the
+    reference to the rest of the shot is kept until it is streamed.
+    '''
+
+    def __init__(self, batch_size, length, num_features_x, num_features_y,
+                 buffer_length, dtype, max_buffer_length=None):
+        self.batch_size = batch_size
+        self.length = length
+        self.dtype = dtype
+        self.max_buffer_length = None
+        if max_buffer_length:
+            self.max_buffer_length = max(
+                length, (max_buffer_length//length)*length)
+            buffer_length = min(buffer_length, self.max_buffer_length)
+        self.buffer_length = max(buffer_length, length)
+        self.X = np.zeros((batch_size, self.buffer_length, num_features_x),
+                          dtype=dtype)
+        self.Y = np.zeros((batch_size, self.buffer_length, num_features_y),
+                          dtype=dtype)
+        self.start = np.zeros(batch_size, dtype=np.int64)
+        self.num_unread = np.zeros(batch_size, dtype=np.int64)
+        self.X_out = np.empty((batch_size, length, num_features_x),
+                              dtype=dtype)
+        self.Y_out = np.empty((batch_size, length, num_features_y),
+                              dtype=dtype)
+        self.rows = np.arange(batch_size)[:, np.newaxis]
+        # (sig, res) of the timesteps still to be streamed into each row
+        self.pending = [None]*batch_size
+
+    def get_empty_rows(self):
+        return np.array([i for i in np.where(self.num_unread == 0)[0]
+                         if self.pending[i] is None], dtype=np.int64)
+
+    def get_indices(self, start, num):
+        '''Flat indices of num timesteps of every row from start on'''
+        return self.rows*self.buffer_length + (
+            start[:, np.newaxis] + np.arange(num)[np.newaxis, :]
+            ) % self.buffer_length
+
+    def resize(self, new_length):
+        '''Grow the rows to new_length, unrolling the unread timesteps of
+        every row to its beginning'''
+        indices = self.get_indices(self.start, self.buffer_length)
+        for name in ('X', 'Y'):
+            buff = getattr(self, name)
+            new_buff = np.zeros((self.batch_size, new_length, buff.shape[2]),
+                                dtype=self.dtype)
+            new_buff[:, :self.buffer_length, :] = np.take(
+                buff.reshape(-1, buff.shape[2]), indices, axis=0)
+            setattr(self, name, new_buff)
+        self.start[:] = 0
+        self.buffer_length = new_length
+
+    def append(self, row, sig, res):
+        num = sig.shape[0]
+        if self.num_unread[row] + num > self.buffer_length:
+            new_length = self.num_unread[row] + num + self.length
+            if self.max_buffer_length is not None:
+                new_length = min(new_length, self.max_buffer_length)
+            if new_length > self.buffer_length:
+                self.resize(new_length)
+        # shots are multiples of length long, so segments are too
+        num_free = self.buffer_length - self.num_unread[row]
+        num = min(num, (num_free//self.length)*self.length)
+        positions = (self.start[row] + self.num_unread[row]
+                     + np.arange(num)) % self.buffer_length
+        self.X[row, positions, :] = sig[:num]
+        self.Y[row, positions, :] = res[:num]
+        self.num_unread[row] += num
+        if num < sig.shape[0]:
+            self.pending[row] = (sig[num:], res[num:])
+
+    def stream_pending(self):
+        for row in np.where(self.num_unread < self.length)[0]:
+            if self.pending[row] is not None:
+                sig, res = self.pending[row]
+                self.pending[row] = None
+                self.append(row, sig, res)
+
+    def next_batch(self):
+        self.stream_pending()
+        assert np.all(self.num_unread >= self.length)
+        indices = self.get_indices(self.start, self.length)
+        np.take(self.X.reshape(-1, self.X.shape[2]), indices, axis=0,
+                out=self.X_out)
+        np.take(self.Y.reshape(-1, self.Y.shape[2]), indices, axis=0,
+                out=self.Y_out)
+        self.start = (self.start + self.length) % self.buffer_length
+        self.num_unread -= self.length
+        return self.X_out, self.Y_out
+
+
+class PrefetchGenerator(object):
+    '''Prefetch the batches of a generator in worker processes.
+
+    Each worker runs its own instance of generator_func() and writes the
+    numpy arrays of every batch into one of a fixed ring of num_slots
+    shared-memory slots, sending only their layout through a queue. The
+    consumer receives zero-copy views into the slot; a slot is only handed
+    back to the workers once max_outstanding newer batches have been
+    returned, so a batch stays valid until the next call to next() by
+    default. Workers block when all slots are full (back-pressure), so
+    memory use is bounded by num_slots*slot_nbytes.
+
+    Batches that do not fit into a slot (e.g. after a full-shot generator
+    grows its buffers) are pickled through the queue instead. If
+    slot_nbytes is None, it is set to twice the size of a first batch drawn
+    in the calling process, which costs a batch and advances the random
+    state of the caller; pass it for generators where this matters.
+
+    A single worker continues the random state of the calling process, so
+    it yields the same batches as generator_func() would in-process.
+    Several workers are seeded from it instead.
+
+    The batches of several workers are interleaved, so num_workers > 1 is
+    only meaningful for generators whose batches are independent of each
+    other, i.e. not for stateful (partial reset) training.
+    '''
+
+    def __init__(self, generator_func, num_workers=1, num_slots=4,
+                 slot_nbytes=None, max_outstanding=1):
+        assert num_slots > max_outstanding, (
+            'need more slots than batches held by the consumer')
+        if slot_nbytes is None:
+            slot_nbytes = 2*self.get_batch_nbytes(next(generator_func()))
+        self.num_workers = num_workers
+        self.max_outstanding = max_outstanding
+        self.slots = [mp.RawArray('b', max(1, slot_nbytes))
+                      for _ in range(num_slots)]
+        self.free_queue = mp.Queue()
+        self.ready_queue = mp.Queue()
+        for i in range(num_slots):
+            self.free_queue.put(i)
+        self.stop_event = mp.Event()
+        self.outstanding = []
+        self.num_finished = 0
+        if num_workers == 1:
+            # random (unlike np.random) is reseeded in forked processes
+            seeds = [(np.random.get_state(), random.getstate())]
+        else:
+            seeds = [int(seed) for seed in np.random.randint(
+                0, 2**31 - 1, size=num_workers)]
+        self.procs = [mp.Process(target=self.fill_slots,
+                                 args=(generator_func, seed, self.slots,
+                                       self.free_queue, self.ready_queue,
+                                       self.stop_event))
+                      for seed in seeds]
+        for proc in self.procs:
+            proc.daemon = True
+            proc.start()
+        if num_workers == 1:
+            # the worker draws from a copy of the random state, so advance
+            # it here to not replay the same draws in a restarted generator
+            np.random.randint(2)
+            random.random()
+
+    @staticmethod
+    def get_batch_nbytes(batch):
+        return sum([x.nbytes for x in batch if isinstance(x, np.ndarray)])
+
+    @staticmethod
+    def fill_slots(generator_func, seed, slots, free_queue, ready_queue,
+                   stop_event):
+        # seed is an int, or the random states of the calling process
+        # forked workers would otherwise all shuffle their shots identically
+        if isinstance(seed, tuple):
+            np.random.set_state(seed[0])
+            random.setstate(seed[1])
+        else:
+            np.random.seed(seed)
+            random.seed(seed)
+        try:
+            for batch in generator_func():
+                slot_idx = None
+                while slot_idx is None:
+                    if stop_event.is_set():
+                        return
+                    try:
+                        slot_idx = free_queue.get(True, 0.1)
+                    except queue.Empty:
+                        pass
+                ready_queue.put((slot_idx, PrefetchGenerator.write_to_slot(
+                    slots[slot_idx], batch)))
+            ready_queue.put((None, None))
+        except Exception:
+            ready_queue.put((None, traceback.format_exc()))
+
+    @staticmethod
+    def write_to_slot(slot, batch):
+        '''Copy the arrays of batch into a slot. Returns the layout of the
+        batch: (offset, shape, dtype) for arrays, (None, value) otherwise'''
+        if PrefetchGenerator.get_batch_nbytes(batch) > len(slot):
+            # the queue pickles the batch in a separate thread, after the
+            # generator may have overwritten its arrays
+            return tuple([(None, np.copy(x) if isinstance(x, np.ndarray)
+                           else x) for x in batch])
+        buff = np.frombuffer(slot, dtype=np.uint8)
+        layout = []
+        offset = 0
+        for x in batch:
+            if isinstance(x, np.ndarray):
+                x = np.ascontiguousarray(x)
+                buff[offset:offset + x.nbytes] = x.reshape(-1).view(np.uint8)
+                layout.append((offset, x.shape, x.dtype.str))
+                offset += x.nbytes
+            else:
+                layout.append((None, x))
+        return tuple(layout)
+
+    def read_from_slot(self, slot_idx, layout):
+        buff = np.frombuffer(self.slots[slot_idx], dtype=np.uint8)
+        batch = []
+        for item in layout:
+            if item[0] is None:
+                batch.append(item[1])
+            else:
+                offset, shape, dtype = item
+                dtype = np.dtype(dtype)
+                count = int(np.prod(shape))
+                batch.append(buff[offset:offset + count*dtype.itemsize].view(
+                    dtype).reshape(shape))
+        return tuple(batch)
+
+    def __iter__(self):
+        return self
 
     def __next__(self):
-        return self.queue.get(True)
+        while len(self.outstanding) >= self.max_outstanding:
+            self.free_queue.put(self.outstanding.pop(0))
+        while True:
+            slot_idx, layout = self.ready_queue.get(True)
+            if slot_idx is not None:
+                break
+            if layout is not None:
+                self.close()
+                raise RuntimeError(
+                    'Batch generator failed in worker process:\n' + layout)
+            self.num_finished += 1
+            if self.num_finished == self.num_workers:
+                raise StopIteration
+        self.outstanding.append(slot_idx)
+        return self.read_from_slot(slot_idx, layout)
 
     def next(self):
         return self.__next__()
 
-    def __exit__(self):
-        self.proc.terminate()
-        self.queue.close()
+    def close(self):
+        self.stop_event.set()
+        for proc in self.procs:
+            proc.join(1.0)
+            if proc.is_alive():
+                proc.terminate()
+                proc.join()
+        self.procs = []
+        for q in (self.free_queue, self.ready_queue):
+            q.cancel_join_thread()
+            q.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,12 +1,16 @@
 from __future__ import print_function
 import plasma.global_vars as g
-from plasma.primitives.ops import mpi_sum_f16
+from plasma.primitives.ops import (
+    mpi_sum_f16, GradientBuckets, HierarchicalAllreduce,
+    get_gradient_compressor
+    )
 from plasma.utils.performance import PerformanceAnalyzer
 from plasma.utils.processing import concatenate_sublists
 from plasma.utils.evaluation import get_loss_from_list
 # KGF: this is the first module that imports Keras:
 from plasma.models import builder
-from plasma.models.loader import ProcessGenerator
+from plasma.models.loader import PrefetchGenerator
+from plasma.primitives.shots import ShotList
 from plasma.utils.state_reset import reset_states
 # KGF: plasma.conf calls print_unique() for "Selected signals". Ensure that
 # Keras "Using TensorFlow backend" stderr messages do not interfere in stdout
@@ -189,9 +193,18 @@ class Averager(object):
 
 
 class MPIModel():
+    # private Model attributes used by build_direct_gradient_functions and
+    # get_direct_deltas
+    DIRECT_GRADIENT_ATTRIBUTES = ('_feed_inputs', '_feed_targets',
+                                  '_feed_sample_weights',
+                                  '_standardize_user_data')
+    # local optimizers whose step, divided by DUMMY_LR, is the negated
+    # (clipped) gradient computed by the direct gradient functions
+    DIRECT_GRADIENT_OPTIMIZERS = ('sgd',)
+
     def __init__(self, model, optimizer, comm, batch_iterator, batch_size,
                  num_replicas=None, warmup_steps=1000, lr=0.01,
-                 num_batches_minimum=100, conf=None):
+                 num_batches_minimum=100, conf=None, batch_nbytes=None):
         random.seed(g.task_index)
         np.random.seed(g.task_index)
         self.conf = conf
@@ -206,6 +219,8 @@ class MPIModel():
         self.DUMMY_LR = 0.001
         self.batch_size = batch_size
         self.batch_iterator = batch_iterator
+        # slot size of the prefetching generator, instead of a probe batch
+        self.batch_nbytes = batch_nbytes
         self.set_batch_iterator_func()
         self.warmup_steps = warmup_steps
         self.num_batches_minimum = num_batches_minimum
@@ -222,22 +237,70 @@ class MPIModel():
             self.num_replicas = num_replicas
         self.lr = (lr/(1.0 + self.num_replicas/100.0) if (lr < self.max_lr)
                    else self.max_lr/(1.0 + self.num_replicas/100.0))
+        # fused buffers for sync_deltas, (re)built for the first deltas
+        self.gradient_buckets = None
+        self.gradient_bucket_nbytes = None
+        if (conf is not None and 'gradient_bucket_mb' in conf['training']
+                and conf['training']['gradient_bucket_mb']):
+            self.gradient_bucket_nbytes = int(
+                conf['training']['gradient_bucket_mb']*2**20)
+        # lossy reduction of the deltas, None for a plain Allreduce
+        self.gradient_compressor = None
+        if (conf is not None and 'gradient_compression' in conf['training']
+                and conf['training']['gradient_compression']):
+            topk_ratio = 0.01
+            if 'gradient_topk_ratio' in conf['training']:
+                topk_ratio = conf['training']['gradient_topk_ratio']
+            self.gradient_compressor = get_gradient_compressor(
+                conf['training']['gradient_compression'], topk_ratio)
+        # reduce within each node through shared memory, then between nodes
+        # (with the gradient compressor, if any)
+        self.node_reducer = None
+        if (conf is not None and 'hierarchical_allreduce' in conf['training']
+                and conf['training']['hierarchical_allreduce']):
+            self.node_reducer = HierarchicalAllreduce(
+                comm, self.gradient_compressor)
+        self.gradient_reducer = (self.gradient_compressor
+                                 if self.node_reducer is None
+                                 else self.node_reducer)
+        # overlap the reduction of the deltas with fetching the next batch
+        self.pipelined_steps = (conf is not None
+                                and 'pipelined_steps' in conf['training']
+                                and conf['training']['pipelined_steps'])
+        if self.pipelined_steps and self.gradient_reducer is not None:
+            g.print_unique(
+                'WARNING: the reductions with gradient_compression or '
+                'hierarchical_allreduce are blocking, pipelined_steps does '
+                'not overlap them with fetching the next batch')
+        # deltas from compiled gradient functions instead of get_weights()
+        self.direct_gradients = (conf is not None
+                                 and 'direct_gradients' in conf['training']
+                                 and conf['training']['direct_gradients'])
+        self.gradient_function = None
+        self.apply_function = None
+        # sum over replicas of [num_so_far_indiv, loss], reduced with deltas
+        self.scalar_send = np.zeros(2)
+        self.scalar_recv = np.zeros(2)
 
     def set_batch_iterator_func(self):
+        self.close()
+        # batch fetched ahead of time by a pipelined step
+        self.next_batch = None
         if (self.conf is not None
                 and 'use_process_generator' in conf['training']
                 and conf['training']['use_process_generator']):
-            self.batch_iterator_func = ProcessGenerator(self.batch_iterator())
+            # batches of the stateful partial reset generator must stay in
+            # order, so they are prefetched by a single worker process
+            self.batch_iterator_func = PrefetchGenerator(
+                self.batch_iterator, slot_nbytes=self.batch_nbytes)
         else:
             self.batch_iterator_func = self.batch_iterator()
 
     def close(self):
-        # TODO(KGF): extend __exit__() fn capability when this member
-        # = self.batch_iterator() (i.e. is not a ProcessGenerator())
-        if (self.conf is not None
-                and 'use_process_generator' in conf['training']
-                and conf['training']['use_process_generator']):
-            self.batch_iterator_func.__exit__()
+        batch_iterator_func = getattr(self, 'batch_iterator_func', None)
+        if isinstance(batch_iterator_func, PrefetchGenerator):
+            batch_iterator_func.close()
+        self.batch_iterator_func = None
 
     def set_lr(self, lr):
         self.lr = lr
@@ -288,10 +351,77 @@ class MPIModel():
                                options=self.run_options, run_metadata=self.run_metadata)
         else:
             self.model.compile(optimizer=optimizer_class, loss=loss)
+        if (self.direct_gradients
+                and optimizer not in self.DIRECT_GRADIENT_OPTIMIZERS):
+            # the deltas of other local optimizers are not the gradients,
+            # so the direct path would change the update rule
+            g.print_unique(
+                'WARNING: direct_gradients is only equivalent to the '
+                'get_weights/set_weights deltas with optimizer {}, not {}, '
+                'falling back to get_weights/set_weights'.format(
+                    ' or '.join(self.DIRECT_GRADIENT_OPTIMIZERS), optimizer))
+            self.direct_gradients = False
+        if self.direct_gradients:
+            # the direct gradient functions rely on private attributes of
+            # the compiled tf.keras Model of TF 1.14/1.15 in graph mode
+            missing = [name for name in self.DIRECT_GRADIENT_ATTRIBUTES
+                       if not hasattr(self.model, name)]
+            if missing:
+                g.print_unique(
+                    'WARNING: direct_gradients is not supported by this '
+                    'Keras version (missing {}), falling back to '
+                    'get_weights/set_weights'.format(', '.join(missing)))
+                self.direct_gradients = False
+            else:
+                self.build_direct_gradient_functions(clipnorm)
 
         self.ensure_equal_weights()
 
+    def build_direct_gradient_functions(self, clipnorm):
+        '''
+        Compile the two functions of a direct gradient step: one returning
+        the loss and the deltas of the trainable weights for a mini-batch,
+        i.e. the gradients of the loss, clipped like the Keras optimizers
+        do, negated and unscaled, and one adding the global deltas to the
+        trainable weights in a single session run. These deltas equal those
+        of a local SGD step (see DIRECT_GRADIENT_OPTIMIZERS), which is why
+        compile only uses them with optimizer 'sgd'.
+
+        The states of stateful layers and the moving statistics of batch
+        normalization are updated by the first function, as they would be
+        by train_on_batch. The latter are kept per replica, since only the
+        trainable weights have deltas.
+        '''
+        model = self.model
+        weights = model.trainable_weights
+        grads = K.gradients(model.total_loss, weights)
+        if clipnorm:
+            grads = [tf.clip_by_norm(grad, clipnorm) for grad in grads]
+        scale = -1.0/conf['model']['loss_scale_factor']
+        deltas = [scale*grad for grad in grads]
+        # same inputs as the train function of the compiled Keras model
+        inputs = (model._feed_inputs + model._feed_targets
+                  + model._feed_sample_weights)
+        self.uses_learning_phase = not isinstance(K.learning_phase(), int)
+        if self.uses_learning_phase:
+            inputs.append(K.learning_phase())
+        self.gradient_function = K.function(
+            inputs, [model.total_loss] + deltas, updates=model.updates)
+        delta_placeholders = [
+            K.placeholder(shape=K.int_shape(w), dtype=K.dtype(w))
+            for w in weights]
+        self.apply_function = K.function(
+            delta_placeholders, [], updates=[
+                K.update_add(w, delta) for (w, delta) in zip(
+                    weights, delta_placeholders)])
+
     def ensure_equal_weights(self):
+        if self.node_reducer is not None:
+            weights = self.model.get_weights()
+            buckets = GradientBuckets.from_arrays(weights)
+            buckets.pack(weights)
+            self.model.set_weights(buckets.bcast(self.node_reducer))
+            return
         if g.task_index == 0:
             new_weights = self.model.get_weights()
         else:
@@ -318,12 +448,19 @@ class MPIModel():
           - deltas: a list of model weight updates
           - loss: scalar training loss
 
-        '''
-        weights_before_update = self.model.get_weights()
+        With conf['training']['direct_gradients'], the deltas of the
+        trainable weights are instead computed by a single call to the
+        compiled gradient function, see
+        MPIModel.build_direct_gradient_functions
 
+        '''
         return_sequences = self.conf['model']['return_sequences']
         if not return_sequences:
             Y_batch = Y_batch[:, -1, :]
+        if self.direct_gradients:
+            return self.get_direct_deltas(X_batch, Y_batch)
+
+        weights_before_update = self.model.get_weights()
         loss = self.model.train_on_batch(X_batch, Y_batch)
 
         weights_after_update = self.model.get_weights()
@@ -344,6 +481,15 @@ class MPIModel():
 
         return deltas, loss
 
+    def get_direct_deltas(self, X_batch, Y_batch):
+        x, y, sample_weights = self.model._standardize_user_data(
+            X_batch, Y_batch)
+        ins = x + list(y or []) + list(sample_weights or [])
+        if self.uses_learning_phase:
+            ins.append(1)
+        outputs = self.gradient_function(ins)
+        return outputs[1:], outputs[0]
+
     def get_new_weights(self, deltas):
         return add_params(self.model.get_weights(), deltas)
 
@@ -353,7 +499,9 @@ class MPIModel():
         if self.task_index >= num_replicas:
             arr *= 0.0
         arr_global = np.empty_like(arr)
-        if K.floatx() == 'float16':
+        if self.gradient_reducer is not None:
+            self.gradient_reducer.allreduce(self.comm, arr, arr_global)
+        elif K.floatx() == 'float16':
             self.comm.Allreduce(arr, arr_global, op=mpi_sum_f16)
         else:
             self.comm.Allreduce(arr, arr_global, op=MPI.SUM)
@@ -398,23 +546,81 @@ class MPIModel():
         val_global = self.comm.allreduce(val, op=MPI.SUM)
         return val_global
 
+    def pack_deltas(self, deltas, num_replicas):
+        if (self.gradient_buckets is None
+                or not self.gradient_buckets.matches(deltas)):
+            self.gradient_buckets = GradientBuckets.from_arrays(
+                deltas, self.gradient_bucket_nbytes)
+        if self.task_index >= num_replicas:
+            self.gradient_buckets.zero()
+        else:
+            self.gradient_buckets.pack(deltas)
+
     def sync_deltas(self, deltas, num_replicas=None):
-        global_deltas = []
+        '''
+        Average the deltas over num_replicas. All deltas are packed into
+        preallocated gradient buckets, which are reduced with one Allreduce
+        each instead of one per weight tensor (or with the gradient
+        compressor selected by conf['training']['gradient_compression'], and
+        node by node with conf['training']['hierarchical_allreduce']).
+        The returned arrays are views into the receive buffers, valid until
+        the next call.
+        '''
         # default is to reduce the deltas from all workers
-        for delta in deltas:
-            global_deltas.append(self.mpi_average_gradients(
-                delta, num_replicas))
+        if num_replicas is None:
+            num_replicas = self.num_workers
+        self.pack_deltas(deltas, num_replicas)
+        global_deltas = self.gradient_buckets.allreduce(
+            self.comm, self.gradient_reducer)
+        self.gradient_buckets.average(num_replicas)
         return global_deltas
 
+    def start_sync_deltas(self, deltas, scalars, num_replicas=None):
+        '''
+        Non-blocking version of sync_deltas, which also sums a few scalars
+        over num_replicas (instead of one blocking allreduce per scalar).
+        Returns the requests to pass to finish_sync_deltas, which must be
+        called before the next reduction.
+        '''
+        if num_replicas is None:
+            num_replicas = self.num_workers
+        self.pack_deltas(deltas, num_replicas)
+        self.scalar_send[:] = scalars
+        if self.task_index >= num_replicas:
+            self.scalar_send *= 0.0
+        requests = self.gradient_buckets.start_allreduce(
+            self.comm, self.gradient_reducer)
+        requests.append(self.comm.Iallreduce(
+            self.scalar_send, self.scalar_recv, op=MPI.SUM))
+        return requests
+
+    def finish_sync_deltas(self, requests, num_replicas=None):
+        '''
+        Wait for the reductions started by start_sync_deltas. Returns the
+        averaged deltas (views, as for sync_deltas) and a copy of the summed
+        scalars
+        '''
+        if num_replicas is None:
+            num_replicas = self.num_workers
+        MPI.Request.Waitall(requests)
+        self.gradient_buckets.average(num_replicas)
+        return list(self.gradient_buckets.outputs), self.scalar_recv.copy()
+
     def set_new_weights(self, deltas, num_replicas=None):
         global_deltas = self.sync_deltas(deltas, num_replicas)
+        self.apply_global_deltas(global_deltas, num_replicas)
+
+    def apply_global_deltas(self, global_deltas, num_replicas=None):
         effective_lr = self.get_effective_lr(num_replicas)
 
         self.optimizer.set_lr(effective_lr)
         global_deltas = self.optimizer.get_deltas(global_deltas)
 
-        new_weights = self.get_new_weights(global_deltas)
-        self.model.set_weights(new_weights)
+        if self.direct_gradients:
+            self.apply_function(global_deltas)
+        else:
+            new_weights = self.get_new_weights(global_deltas)
+            self.model.set_weights(new_weights)
 
     def build_callbacks(self, conf, callbacks_list):
         '''
@@ -503,8 +709,15 @@ class MPIModel():
         calculated for each model replica in the ensemble, weights are averaged
         over ensemble, and the new weights are set.
 
+        With conf['training']['pipelined_steps'], the reduction of the deltas,
+        loss and sample count is started with non-blocking collectives, and
+        the next mini-batch is fetched while it is in flight. The update is
+        still applied before the next mini-batch is trained on, so the
+        weights follow the same trajectory as in the sequential mode.
+
         It performs calls to: MPIModel.get_deltas, MPIModel.set_new_weights
-        methods
+        (or MPIModel.start_sync_deltas, MPIModel.finish_sync_deltas and
+        MPIModel.apply_global_deltas) methods
 
         Argument list: Empty
 
@@ -536,7 +749,6 @@ class MPIModel():
                 and conf['training']['step_limit'] > 0):
             step_limit = conf['training']['step_limit']
 
-        batch_iterator_func = self.batch_iterator_func
         num_total = 1
         ave_loss = -1
         curr_loss = -1
@@ -549,16 +761,8 @@ class MPIModel():
             if step_limit > 0 and step > step_limit:
                 print('reached step limit')
                 break
-            try:
-                (batch_xs, batch_ys, batches_to_reset, num_so_far_curr,
-                 num_total, is_warmup_period) = next(batch_iterator_func)
-            except StopIteration:
-                g.print_unique("Resetting batch iterator.")
-                self.num_so_far_accum = self.num_so_far_indiv
-                self.set_batch_iterator_func()
-                batch_iterator_func = self.batch_iterator_func
-                (batch_xs, batch_ys, batches_to_reset, num_so_far_curr,
-                 num_total, is_warmup_period) = next(batch_iterator_func)
+            (batch_xs, batch_ys, batches_to_reset, num_so_far_curr,
+             num_total, is_warmup_period) = self.get_next_batch()
             self.num_so_far_indiv = self.num_so_far_accum + num_so_far_curr
 
             # if batches_to_reset:
@@ -567,8 +771,10 @@ class MPIModel():
             warmup_phase = (step < self.warmup_steps and self.epoch == 0)
             num_replicas = 1 if warmup_phase else self.num_replicas
 
-            self.num_so_far = self.mpi_sum_scalars(
-                self.num_so_far_indiv, num_replicas)
+            # a pipelined step reduces num_so_far together with the deltas
+            if not self.pipelined_steps or is_warmup_period:
+                self.num_so_far = self.mpi_sum_scalars(
+                    self.num_so_far_indiv, num_replicas)
 
             # run the model once to force compilation. Don't actually use these
             # values.
@@ -597,10 +803,26 @@ class MPIModel():
                 batch_xs, batch_ys, verbose)
             t1 = time.time()
             if not is_warmup_period:
-                self.set_new_weights(deltas, num_replicas)
+                if self.pipelined_steps:
+                    requests = self.start_sync_deltas(
+                        deltas, [self.num_so_far_indiv, loss], num_replicas)
+                    # fetch the next batch while the reduction is in flight
+                    t_fetch = time.time()
+                    self.next_batch = self.get_next_batch()
+                    t_fetch = time.time() - t_fetch
+                    global_deltas, scalars = self.finish_sync_deltas(
+                        requests, num_replicas)
+                    self.apply_global_deltas(global_deltas, num_replicas)
+                    self.num_so_far = scalars[0]
+                    curr_loss = scalars[1]/num_replicas
+                else:
+                    t_fetch = 0.0
+                    self.set_new_weights(deltas, num_replicas)
+                    curr_loss = self.mpi_average_scalars(1.0*loss,
+                                                         num_replicas)
                 t2 = time.time()
-                write_str_0 = self.calculate_speed(t0, t1, t2, num_replicas)
-                curr_loss = self.mpi_average_scalars(1.0*loss, num_replicas)
+                write_str_0 = self.calculate_speed(t0, t1, t2, num_replicas,
+                                                   t_fetch=t_fetch)
                 # g.print_unique(self.model.get_weights()[0][0][:4])
                 loss_averager.add_val(curr_loss)
                 ave_loss = loss_averager.get_ave()
@@ -643,6 +865,24 @@ class MPIModel():
             + ' in {:.2f} seconds\n'.format(t2 - t_start))
         return (step, ave_loss, curr_loss, self.num_so_far, effective_epochs)
 
+    def get_next_batch(self):
+        '''
+        Return the batch fetched ahead of time by a pipelined step if there
+        is one, otherwise the next batch of the batch iterator, which is
+        restarted when exhausted
+        '''
+        if self.next_batch is not None:
+            batch = self.next_batch
+            self.next_batch = None
+            return batch
+        try:
+            return next(self.batch_iterator_func)
+        except StopIteration:
+            g.print_unique("Resetting batch iterator.")
+            self.num_so_far_accum = self.num_so_far_indiv
+            self.set_batch_iterator_func()
+            return next(self.batch_iterator_func)
+
     def estimate_remaining_time(self, time_so_far, work_so_far, work_total):
         eps = 1e-6
         total_time = 1.0*time_so_far*work_total/(work_so_far + eps)
@@ -662,11 +902,14 @@ class MPIModel():
         return self.batch_size*num_replicas
 
     def calculate_speed(self, t0, t_after_deltas, t_after_update, num_replicas,
-                        verbose=False):
+                        verbose=False, t_fetch=0.0):
+        '''t_fetch is the time spent fetching the next batch between
+        t_after_deltas and t_after_update (by a pipelined step), which is
+        counted as neither computation nor synchronization'''
         effective_batch_size = self.get_effective_batch_size(num_replicas)
         t_calculate = t_after_deltas - t0
-        t_sync = t_after_update - t_after_deltas
-        t_tot = t_after_update - t0
+        t_sync = t_after_update - t_after_deltas - t_fetch
+        t_tot = t_after_update - t0 - t_fetch
 
         examples_per_sec = effective_batch_size/t_tot
         frac_calculate = t_calculate/t_tot
@@ -725,10 +968,6 @@ def mpi_make_predictions(conf, shot_list, loader, custom_path=None):
     shot_list.sort()  # make sure all replicas have the same list
     specific_builder = builder.ModelBuilder(conf)
 
-    y_prime = []
-    y_gold = []
-    disruptive = []
-
     model = specific_builder.build_model(True)
     specific_builder.load_model_weights(model, custom_path)
 
@@ -749,11 +988,20 @@ def mpi_make_predictions(conf, shot_list, loader, custom_path=None):
         #
         # 128/862 [===>..........................] - ETA: 2:20
         pbar = Progbar(len(shot_list))
-    shot_sublists = shot_list.sublists(conf['model']['pred_batch_size'],
-                                       do_shuffle=False, equal_size=True)
-    y_prime_global = []
-    y_gold_global = []
-    disruptive_global = []
+    # batch shots of similar length together, so that little of the
+    # prediction is spent on padding; the outputs are put back in the order
+    # of shot_list below
+    batch_size = conf['model']['pred_batch_size']
+    buckets = loader.get_length_buckets(loader.get_shot_lengths(shot_list),
+                                        batch_size)
+    shot_sublists = [ShotList([shot_list.shots[j] for j in bucket])
+                     for bucket in buckets]
+    y_prime_global = [None]*len(shot_list)
+    y_gold_global = [None]*len(shot_list)
+    disruptive_global = [None]*len(shot_list)
+    results = []
+    num_timesteps_useful = 0
+    num_timesteps_computed = 0
     if g.task_index != 0:
         loader.verbose = False
 
@@ -762,7 +1010,7 @@ def mpi_make_predictions(conf, shot_list, loader, custom_path=None):
             X, y, shot_lengths, disr = loader.load_as_X_y_pred(shot_sublist)
 
             # load data and fit on data
-            y_p = model.predict(X, batch_size=conf['model']['pred_batch_size'])
+            y_p = model.predict(X, batch_size=batch_size)
             model.reset_states()
             y_p = loader.batch_output_to_array(y_p)
             y = loader.batch_output_to_array(y)
@@ -771,29 +1019,33 @@ def mpi_make_predictions(conf, shot_list, loader, custom_path=None):
             y_p = [arr[:shot_lengths[j]] for (j, arr) in enumerate(y_p)]
             y = [arr[:shot_lengths[j]] for (j, arr) in enumerate(y)]
 
-            y_prime += y_p
-            y_gold += y
-            disruptive += disr
+            # copies of a shot filling up the last batch only count as padding
+            _, first = np.unique(buckets[i], return_index=True)
+            num_timesteps_useful += sum([shot_lengths[j] for j in first])
+            num_timesteps_computed += X.shape[0]*X.shape[1]
+            results += list(zip(buckets[i], y_p, y, disr))
             # print_all('\nFinished with i = {}'.format(i))
 
         if (i % g.num_workers == g.num_workers - 1
                 or i == len(shot_sublists) - 1):
             g.comm.Barrier()
-            y_prime_global += concatenate_sublists(g.comm.allgather(y_prime))
-            y_gold_global += concatenate_sublists(g.comm.allgather(y_gold))
-            disruptive_global += concatenate_sublists(
-                g.comm.allgather(disruptive))
+            for (j, y_p, y, disr) in concatenate_sublists(
+                    g.comm.allgather(results)):
+                y_prime_global[j] = y_p
+                y_gold_global[j] = y
+                disruptive_global[j] = disr
             g.comm.Barrier()
-            y_prime = []
-            y_gold = []
-            disruptive = []
+            results = []
 
         if g.task_index == 0:
             pbar.add(1.0*len(shot_sublist))
 
-    y_prime_global = y_prime_global[:len(shot_list)]
-    y_gold_global = y_gold_global[:len(shot_list)]
-    disruptive_global = disruptive_global[:len(shot_list)]
+    num_timesteps_useful = g.comm.allreduce(num_timesteps_useful)
+    num_timesteps_computed = g.comm.allreduce(num_timesteps_computed)
+    g.print_unique('\nPadding efficiency of predictions: {:.1f}% '.format(
+        100.0*num_timesteps_useful/max(1, num_timesteps_computed))
+        + '({} of {} timesteps)'.format(num_timesteps_useful,
+                                        num_timesteps_computed))
     loader.set_inference_mode(False)
 
     return y_prime_global, y_gold_global, disruptive_global
@@ -897,13 +1149,19 @@ def mpi_train(conf, shot_list_train, shot_list_validate, loader,
 
     g.print_unique('{} epoch(s) left to go'.format(num_epochs - e))
 
+    # batches prefetched by a PrefetchGenerator are copied into its shared
+    # slots, so the generator does not need to copy them
+    copy_batches = not ('use_process_generator' in conf['training']
+                        and conf['training']['use_process_generator'])
     batch_generator = partial(loader.training_batch_generator_partial_reset,
-                              shot_list=shot_list_train)
+                              shot_list=shot_list_train,
+                              copy_batches=copy_batches)
 
     g.print_unique("warmup steps = {}".format(warmup_steps))
     mpi_model = MPIModel(train_model, optimizer, g.comm, batch_generator,
                          batch_size, lr=lr, warmup_steps=warmup_steps,
-                         num_batches_minimum=num_batches_minimum, conf=conf)
+                         num_batches_minimum=num_batches_minimum, conf=conf,
+                         batch_nbytes=loader.get_training_batch_nbytes())
     mpi_model.compile(conf['model']['optimizer'], clipnorm,
                       conf['data']['target'].loss)
     tensorboard = None
@@ -977,9 +1235,8 @@ def mpi_train(conf, shot_list_train, shot_list_validate, loader,
                  conf, shot_list_train, loader)
             batch_generator = partial(
                 loader.training_batch_generator_partial_reset,
-                shot_list=shot_list_train)
+                shot_list=shot_list_train, copy_batches=copy_batches)
             mpi_model.batch_iterator = batch_generator
-            mpi_model.batch_iterator_func.__exit__()
             mpi_model.num_so_far_accum = mpi_model.num_so_far_indiv
             mpi_model.set_batch_iterator_func()
 
@@ -1050,6 +1307,8 @@ def mpi_train(conf, shot_list_train, shot_list_validate, loader,
         tensorboard.on_train_end()
 
     mpi_model.close()
+    if mpi_model.node_reducer is not None:
+        mpi_model.node_reducer.free()
 
 
 def get_stop_training(callbacks):
@@ -119,9 +119,8 @@ class FeatureExtractor(object):
         save_path = shot.get_save_path(save_prepath)
         if not os.path.exists(save_prepath):
             makedirs_process_safe(save_prepath)
-        prepath = self.loader.conf['paths']['processed_prepath']
         assert shot.valid
-        shot.restore(prepath)
+        self.loader.restore_shot(shot)
         self.loader.set_inference_mode(True)  # make sure shots aren't cut
         if self.loader.normalizer is not None:
             self.loader.normalizer.apply(shot)
@@ -318,7 +318,8 @@ def apply_model_to_np(model, x):
 
 
 def make_predictions(conf, shot_list, loader, custom_path=None):
-    generator = loader.inference_batch_generator_full_shot(shot_list)
+    generator = loader.inference_batch_generator_full_shot(
+        shot_list, bucketed=True)
     inference_model = build_torch_model(conf)
 
     if custom_path is None:
@@ -328,29 +329,32 @@ def make_predictions(conf, shot_list, loader, custom_path=None):
     inference_model.load_state_dict(torch.load(model_path))
     # shot_list = shot_list.random_sublist(10)
 
-    y_prime = []
-    y_gold = []
-    disruptive = []
     num_shots = len(shot_list)
+    # the batches come in order of shot length, with the positions of their
+    # shots in shot_list
+    y_prime = [None]*num_shots
+    y_gold = [None]*num_shots
+    disruptive = [None]*num_shots
+    num_done = 0
 
     pbar = tqdm.tqdm(total=num_shots, desc='Predictions')
-    while True:
-        x, y, mask, disr, lengths, num_so_far, num_total = next(generator)
+    while num_done < num_shots:
+        (x, y, mask, disr, lengths, num_so_far, num_total,
+         indices) = next(generator)
         # x, y, mask = Variable(torch.from_numpy(x_).float()),
         # Variable(torch.from_numpy(y_).float()),
         # Variable(torch.from_numpy(mask_).byte())
         output = apply_model_to_np(inference_model, x)
         for batch_idx in range(x.shape[0]):
+            shot_idx = indices[batch_idx]
+            if disruptive[shot_idx] is not None:
+                continue  # copy of a shot filling up the last batch
             curr_length = lengths[batch_idx]
-            y_prime += [output[batch_idx, :curr_length, 0]]
-            y_gold += [y[batch_idx, :curr_length, 0]]
-            disruptive += [disr[batch_idx]]
+            y_prime[shot_idx] = output[batch_idx, :curr_length, 0]
+            y_gold[shot_idx] = y[batch_idx, :curr_length, 0]
+            disruptive[shot_idx] = disr[batch_idx]
+            num_done += 1
             pbar.update(1.0)
-        if len(disruptive) >= num_shots:
-            y_prime = y_prime[:num_shots]
-            y_gold = y_gold[:num_shots]
-            disruptive = disruptive[:num_shots]
-            break
     return y_prime, y_gold, disruptive
 
 
@@ -409,9 +413,9 @@ def train_epoch(model, data_gen, optimizer, loss_fn):
 
 def train(conf, shot_list_train, shot_list_validate, loader):
     np.random.seed(1)
-    # data_gen = ProcessGenerator(partial(
-    # loader.training_batch_generator_full_shot_partial_reset,shot_list
-    # = shot_list_train)())
+    # data_gen = loader.training_batch_generator_process(
+    #     shot_list_train,
+    #     loader.training_batch_generator_full_shot_partial_reset)
     data_gen = partial(
         loader.training_batch_generator_full_shot_partial_reset,
         shot_list=shot_list_train)()
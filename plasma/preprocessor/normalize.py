@@ -12,14 +12,15 @@ from __future__ import print_function
 import plasma.global_vars as g
 import os
 import time
-import sys
 import abc
 
 import numpy as np
-from scipy.signal import exponential, correlate
+from scipy.signal import exponential
 import pathos.multiprocessing as mp
 
 from plasma.primitives.shots import ShotList, Shot
+from plasma.utils.processing import correlate_valid
+from plasma.utils.stats import RunningMoments, QuantileSketch
 
 '''TODO
 - incorporate stats, pass machine (perhaps save machine in stats object!)
@@ -37,7 +38,9 @@ class Stats(object):
     pass
 
 
-class Normalizer(object):
+class Normalizer(object, metaclass=abc.ABCMeta):
+    accumulator_names = ()
+
     def __init__(self, conf):
         self.num_processed = dict()
         self.num_disruptive = dict()
@@ -49,6 +52,11 @@ class Normalizer(object):
         self.bound = np.Inf
         if 'norm_stat_range' in self.conf['data']:
             self.bound = self.conf['data']['norm_stat_range']
+        # per (machine, signals) channel coefficients, see get_coefficients
+        self.coefficients = dict()
+        # set once the stats were computed and saved by this process, so
+        # that recompute_normalization does not compute them twice
+        self.stats_up_to_date = False
 
     @abc.abstractmethod
     def __str__(self):
@@ -74,6 +82,59 @@ class Normalizer(object):
     def load_stats(self, verbose=False):
         pass
 
+    @abc.abstractmethod
+    def get_offsets_and_scales(self, machine):
+        '''Return the per-signal offset and scale of a machine, such that a
+        normalized signal is (signal - offset)/scale'''
+        pass
+
+    def get_coefficients(self, machine, signals):
+        '''
+        Expand the per-signal offsets and scales of a machine to one entry
+        per channel of the concatenated signals, together with the lower
+        bound of the positivity constraint and the clipping range. They are
+        computed once per (machine, signals) and cached until the stats
+        change.
+        '''
+        key = (machine, tuple(signals))
+        if key not in self.coefficients:
+            offsets, scales = self.get_offsets_and_scales(machine)
+            num_channels = [sig.num_channels for sig in signals]
+            normalize = np.array([sig.normalize for sig in signals])
+            positive = np.array([getattr(sig, 'is_strictly_positive', False)
+                                 for sig in signals])
+            scales = np.where(scales == 0.0, 1.0, scales)
+            offsets = np.where(normalize, offsets, 0.0)
+            scales = np.where(normalize, scales, 1.0)
+            bounds = np.where(normalize, self.bound, np.inf)
+            self.coefficients[key] = (
+                np.repeat(np.where(positive, 0.0, -np.inf), num_channels),
+                np.repeat(offsets, num_channels),
+                np.repeat(scales, num_channels),
+                np.repeat(bounds, num_channels))
+        return self.coefficients[key]
+
+    def apply_coefficients(self, shot):
+        '''
+        Apply the positivity constraint, (signal - offset)/scale and the
+        clipping to all signals of a shot in one pass over their
+        concatenated matrix. signals_dict is set to views into the result.
+        '''
+        lower, offsets, scales, bounds = self.get_coefficients(
+            shot.machine, shot.signals)
+        arrays = [shot.signals_dict[sig] for sig in shot.signals]
+        # the concatenation is the only copy; the rest is done in place
+        signal_array = np.concatenate(arrays, axis=1)
+        np.maximum(signal_array, lower, out=signal_array)
+        signal_array -= offsets
+        signal_array /= scales
+        np.clip(signal_array, -bounds, bounds, out=signal_array)
+        curr_idx = 0
+        for (sig, arr) in zip(shot.signals, arrays):
+            shot.signals_dict[sig] = signal_array[
+                :, curr_idx:curr_idx + arr.shape[1]]
+            curr_idx += arr.shape[1]
+
     def print_summary(self, action='loaded'):
         g.print_unique(
             '{} normalization data from {} shots ( {} disruptive )'.format(
@@ -82,13 +143,39 @@ class Normalizer(object):
     def set_inference_mode(self, val):
         self.inference_mode = val
 
+    def get_partial_stats(self):
+        '''Return the stats incorporated so far, to be merged into the
+        normalizer of another worker with merge_partial_stats()'''
+        partial = {'num_processed': self.num_processed,
+                   'num_disruptive': self.num_disruptive,
+                   'machines': self.machines}
+        for name in self.accumulator_names:
+            partial[name] = getattr(self, name)
+        return partial
+
+    def merge_partial_stats(self, partial):
+        for machine in partial['num_processed']:
+            self.ensure_machine(machine)
+            self.num_processed[machine] += partial['num_processed'][machine]
+            self.num_disruptive[machine] += (
+                partial['num_disruptive'][machine])
+        self.machines = set(self.machines) | set(partial['machines'])
+        for name in self.accumulator_names:
+            accumulators = getattr(self, name)
+            for (machine, acc) in partial[name].items():
+                if machine in accumulators:
+                    accumulators[machine].merge(acc)
+                else:
+                    accumulators[machine] = acc
+        self.coefficients = dict()
+
     def ensure_machine(self, machine):
-        if machine not in self.means:
+        if machine not in self.num_processed:
             self.num_processed[machine] = 0
             self.num_disruptive[machine] = 0
     # Modify the above to change the specifics of the normalization scheme
 
-    def train(self, verbose=False):
+    def get_training_shot_files(self):
         conf = self.conf
         # only use training shots here!! "Don't touch testing shots"
         # + conf['paths']['shot_files_test']
@@ -103,35 +190,67 @@ class Normalizer(object):
             print('Testing set contains new machine, using testing set ',
                   'to train normalizer for that machine.')
             shot_files_use = shot_files_all
+        return shot_files_use, all_machines
 
-        # shot_list_dir = conf['paths']['shot_list_dir']
-        use_shots = max(400, conf['data']['use_shots'])
-        return self.train_on_files(shot_files_use, use_shots, all_machines,
-                                   verbose=verbose)
-
-    def train_on_files(self, shot_files, use_shots, all_machines,
-                       verbose=False):
-        conf = self.conf
-        all_signals = conf['paths']['all_signals']
-        shot_list = ShotList()
-        shot_list.load_from_shot_list_files_objects(shot_files, all_signals)
-        shot_list_picked = shot_list.random_sublist(use_shots)
-
+    def get_machines_to_compute(self, all_machines):
         previously_saved, machines_saved = self.previously_saved_stats()
         machines_to_compute = all_machines - machines_saved
-        recompute = conf['data']['recompute_normalization']
+        recompute = (self.conf['data']['recompute_normalization']
+                     and not self.stats_up_to_date)
         if recompute:
             machines_to_compute = all_machines
             previously_saved = False
+        return previously_saved, machines_to_compute
+
+    def train(self, verbose=False, distributed=False):
+        shot_files_use, all_machines = self.get_training_shot_files()
+        # shot_list_dir = conf['paths']['shot_list_dir']
+        use_shots = max(400, self.conf['data']['use_shots'])
+        return self.train_on_files(shot_files_use, use_shots, all_machines,
+                                   verbose=verbose, distributed=distributed)
+
+    def train_on_files(self, shot_files, use_shots, all_machines,
+                       verbose=False, distributed=False):
+        '''Train the normalizer on a random sublist of the shot files.
+
+        With distributed=True, all MPI ranks must call this method. Rank 0
+        picks the shots and the machines to compute, every rank incorporates
+        the stats of its shard of the shots with a local process pool, and
+        the partial results are gathered and merged on rank 0, which saves
+        them. The other ranks then load the saved stats.
+        '''
+        conf = self.conf
+        distributed = distributed and g.comm is not None
+        is_root = not distributed or g.task_index == 0
+        shot_list_picked = None
+        previously_saved, machines_to_compute = None, None
+        if is_root:
+            all_signals = conf['paths']['all_signals']
+            shot_list = ShotList()
+            shot_list.load_from_shot_list_files_objects(shot_files,
+                                                        all_signals)
+            shot_list_picked = shot_list.random_sublist(use_shots)
+            previously_saved, machines_to_compute = (
+                self.get_machines_to_compute(all_machines))
+        if distributed:
+            previously_saved, machines_to_compute = g.comm.bcast(
+                (previously_saved, machines_to_compute), root=0)
         if not previously_saved or len(machines_to_compute) > 0:
-            if previously_saved:
+            if previously_saved and is_root:
                 self.load_stats(verbose=True)
-            print('computing normalization for machines {}'.format(
-                machines_to_compute))
             use_cores = max(1, mp.cpu_count()-2)
+            if distributed:
+                shot_list_picked = g.comm.bcast(shot_list_picked, root=0)
+            num_picked = len(shot_list_picked)
+            if distributed:
+                shot_list_picked = ShotList(
+                    shot_list_picked.shots[g.task_index::g.num_workers])
+                use_cores = max(1, use_cores//g.get_local_size())
+            g.print_unique('computing normalization for machines {}'.format(
+                machines_to_compute))
             pool = mp.Pool(use_cores)
-            print('running in parallel on {} processes'.format(
-                pool._processes))
+            g.print_unique('running in parallel on {} processes'.format(
+                pool._processes) + (' per MPI rank' if distributed else ''))
             start_time = time.time()
 
             for (i, stats) in enumerate(pool.imap_unordered(
@@ -141,14 +260,27 @@ class Normalizer(object):
                 if stats.machine in machines_to_compute:
                     self.incorporate_stats(stats)
                     self.machines.add(stats.machine)
-                sys.stdout.write('\r'
-                                 + '{}/{}'.format(i, len(shot_list_picked)))
+                g.write_unique('\r'
+                               + '{}/{}'.format(i, len(shot_list_picked)))
             pool.close()
             pool.join()
-            print('\nFinished Training Normalizer on ',
-                  '{} files in {} seconds'.format(len(shot_list_picked),
-                                                  time.time()-start_time))
-            self.save_stats(verbose=True)
+            if distributed:
+                partial_stats = g.comm.gather(
+                    self.get_partial_stats() if not is_root else None,
+                    root=0)
+                if is_root:
+                    for partial in partial_stats[1:]:
+                        self.merge_partial_stats(partial)
+            g.print_unique('\nFinished Training Normalizer on '
+                           + '{} files in {} seconds'.format(
+                               num_picked, time.time()-start_time))
+            if is_root:
+                self.save_stats(verbose=True)
+            self.stats_up_to_date = True
+            if distributed:
+                g.comm.Barrier()
+                if not is_root:
+                    self.load_stats()
         else:
             self.load_stats(verbose=verbose)
         # print representation of trained Normalizer to stdout:
@@ -214,6 +346,9 @@ class Normalizer(object):
 
 
 class MeanVarNormalizer(Normalizer):
+    # mergeable per-machine stats, see merge_partial_stats
+    accumulator_names = ('means', 'stds')
+
     def __init__(self, conf):
         Normalizer.__init__(self, conf)
         self.means = dict()
@@ -225,8 +360,8 @@ class MeanVarNormalizer(Normalizer):
     def __str__(self):
         s = ''
         for machine in self.means:
-            means = np.median(self.means[machine], axis=0)
-            stds = np.median(self.stds[machine], axis=0)
+            means = self.means[machine].median()
+            stds = self.stds[machine].median()
             s += 'Machine = {}:\nMean Var Normalizer.\n'.format(machine)
             s += 'means: {}\nstds: {}'.format(means, stds)
         return s
@@ -252,39 +387,28 @@ class MeanVarNormalizer(Normalizer):
     def incorporate_stats(self, stats):
         machine = stats.machine
         self.ensure_machine(stats.machine)
+        self.coefficients = dict()
         if stats.valid:
-            means = stats.means
-            stds = stats.stds
-            if self.num_processed[machine] == 0:
-                self.means[machine] = means
-                self.stds[machine] = stds
-            else:
-                self.means[machine] = np.concatenate(
-                    (self.means[machine], means), axis=0)
-                self.stds[machine] = np.concatenate(
-                    (self.stds[machine], stds), axis=0)
+            # bounded-memory sketches of the per-shot means and stds, from
+            # which the medians over all shots are estimated
+            if machine not in self.means:
+                self.means[machine] = QuantileSketch()
+                self.stds[machine] = QuantileSketch()
+            self.means[machine].update(stats.means)
+            self.stds[machine].update(stats.stds)
             self.num_processed[machine] = self.num_processed[machine] + 1
             self.num_disruptive[machine] = (
                 self.num_disruptive[machine]
                 + (1 if stats.is_disruptive else 0))
 
-    def apply(self, shot):
-        apply_positivity(shot)
-        m = shot.machine
-        assert self.means[m] is not None and self.stds[m] is not None, (
+    def get_offsets_and_scales(self, machine):
+        assert (self.means[machine] is not None
+                and self.stds[machine] is not None), (
             "self.means or self.stds not initialized")
-        means = np.median(self.means[m], axis=0)
-        stds = np.median(self.stds[m], axis=0)
-        for (i, sig) in enumerate(shot.signals):
-            if sig.normalize:
-                stds_curr = stds[i]
-                if stds_curr == 0.0:
-                    stds_curr = 1.0
-                shot.signals_dict[sig] = (
-                    shot.signals_dict[sig] - means[i])/stds_curr
-                shot.signals_dict[sig] = np.clip(
-                    shot.signals_dict[sig], -self.bound, self.bound)
+        return self.means[machine].median(), self.stds[machine].median()
 
+    def apply(self, shot):
+        self.apply_coefficients(shot)
         shot.ttd = self.remapper(shot.ttd, self.conf['data']['T_warning'])
         self.cut_end_of_shot(shot)
         # self.apply_positivity_mask(shot)
@@ -304,11 +428,15 @@ class MeanVarNormalizer(Normalizer):
     def load_stats(self, verbose=False):
         assert self.previously_saved_stats()[0], "stats not saved before"
         dat = np.load(self.path, encoding="latin1", allow_pickle=True)
-        self.means = dat['means'][()]
-        self.stds = dat['stds'][()]
+        # files saved before the sketches hold one row of stats per shot
+        self.means = {m: as_quantile_sketch(v)
+                      for (m, v) in dat['means'][()].items()}
+        self.stds = {m: as_quantile_sketch(v)
+                     for (m, v) in dat['stds'][()].items()}
         self.num_processed = dat['num_processed'][()]
         self.num_disruptive = dat['num_disruptive'][()]
         self.machines = dat['machines'][()]
+        self.coefficients = dict()
         # for machine in self.means:
         #     g.print_unique('Machine = {}:'.format(machine))
         if verbose:
@@ -316,27 +444,15 @@ class MeanVarNormalizer(Normalizer):
 
 
 class VarNormalizer(MeanVarNormalizer):
-    def apply(self, shot):
-        apply_positivity(shot)
-        assert self.means is not None and self.stds is not None, (
-            "self.means or self.stds not initialized")
-        m = shot.machine
-        stds = np.median(self.stds[m], axis=0)
-        for (i, sig) in enumerate(shot.signals):
-            if sig.normalize:
-                stds_curr = stds[i]
-                if stds_curr == 0.0:
-                    stds_curr = 1.0
-                shot.signals_dict[sig] = (shot.signals_dict[sig])/stds_curr
-                shot.signals_dict[sig] = np.clip(
-                    shot.signals_dict[sig], -self.bound, self.bound)
-        shot.ttd = self.remapper(shot.ttd, self.conf['data']['T_warning'])
-        self.cut_end_of_shot(shot)
+    def get_offsets_and_scales(self, machine):
+        assert self.stds[machine] is not None, "self.stds not initialized"
+        stds = self.stds[machine].median()
+        return np.zeros_like(stds), stds
 
     def __str__(self):
         s = ''
         for m in self.stds:
-            stds = np.median(self.stds[m], axis=0)
+            stds = self.stds[m].median()
             s += 'Machine: {}:\n'.format(m)
             s += 'Var Normalizer.\nstds: {}\n'.format(stds)
         return s
@@ -344,27 +460,37 @@ class VarNormalizer(MeanVarNormalizer):
 
 class AveragingVarNormalizer(VarNormalizer):
     def apply(self, shot):
-        apply_positivity(shot)
         super(AveragingVarNormalizer, self).apply(shot)
         window_decay = self.conf['data']['window_decay']
         window_size = self.conf['data']['window_size']
         window = exponential(window_size, 0, window_decay, False)
         window /= np.sum(window)
-        for (i, sig) in enumerate(shot.signals):
-            if sig.normalize:
-                shot.signals_dict[sig] = np.apply_along_axis(
-                    lambda m: correlate(m, window, 'valid'),
-                    axis=0, arr=shot.signals_dict[sig])
-                shot.signals_dict[sig] = np.clip(
-                    shot.signals_dict[sig], -self.bound, self.bound)
-        shot.ttd = shot.ttd[-shot.signals.shape[0]:]
+        arrays = [shot.signals_dict[sig] for sig in shot.signals]
+        signal_array = np.concatenate(arrays, axis=1)
+        smooth = np.concatenate(
+            [np.full(arr.shape[1], sig.normalize, dtype=bool)
+             for (sig, arr) in zip(shot.signals, arrays)])
+        # smooth all normalized channels in one call; the other channels
+        # are cut to the same (valid) length to stay aligned with the ttd
+        num_steps = max(0, signal_array.shape[0] - window_size + 1)
+        result = np.array(signal_array[signal_array.shape[0] - num_steps:],
+                          dtype=np.result_type(signal_array, window))
+        result[:, smooth] = np.clip(
+            correlate_valid(signal_array[:, smooth], window),
+            -self.bound, self.bound)
+        curr_idx = 0
+        for (sig, arr) in zip(shot.signals, arrays):
+            shot.signals_dict[sig] = result[
+                :, curr_idx:curr_idx + arr.shape[1]]
+            curr_idx += arr.shape[1]
+        shot.ttd = shot.ttd[-num_steps:] if num_steps > 0 else shot.ttd[:0]
 
     def __str__(self):
         window_decay = self.conf['data']['window_decay']
         window_size = self.conf['data']['window_size']
         s = ''
         for m in self.stds:
-            stds = np.median(self.stds[m], axis=0)
+            stds = self.stds[m].median()
             s += 'Machine: {}:\n'.format(m)
             s += 'Averaging Var Normalizer.\nstds: '
             s += ' {}\nWindow size: {}, Window decay: {}'.format(
@@ -373,10 +499,14 @@ class AveragingVarNormalizer(VarNormalizer):
 
 
 class MinMaxNormalizer(Normalizer):
+    # mergeable per-machine stats, see merge_partial_stats
+    accumulator_names = ('minimums', 'maximums')
+
     def __init__(self, conf):
         Normalizer.__init__(self, conf)
-        self.minimums = None
-        self.maximums = None
+        # running averages of the per-shot minimums and maximums
+        self.minimums = dict()
+        self.maximums = dict()
         self.bound = np.Inf
         if 'norm_stat_range' in self.conf['data']:
             self.bound = self.conf['data']['norm_stat_range']
@@ -384,9 +514,9 @@ class MinMaxNormalizer(Normalizer):
     def __str__(self):
         s = ''
         for m in self.minimums:
-            s += 'Machine {}:\n.Min Max Normalizer.\n'.format(m,
-                                                              self.minimums[m])
-            s += 'minimums: {}\nmaximums: {}'.format(self.maximums[m])
+            s += 'Machine {}:\nMin Max Normalizer.\n'.format(m)
+            s += 'minimums: {}\nmaximums: {}\n'.format(
+                self.minimums[m].mean, self.maximums[m].mean)
         return s
 
     def extract_stats(self, shot):
@@ -404,37 +534,25 @@ class MinMaxNormalizer(Normalizer):
 
     def incorporate_stats(self, stats):
         self.ensure_machine(stats.machine)
+        self.coefficients = dict()
         if stats.valid:
             m = stats.machine
-            minimums = stats.minimums
-            maximums = stats.maximums
-            if self.num_processed == 0:
-                self.minimums[m] = minimums
-                self.maximums[m] = maximums
-            else:
-                self.minimums[m] = (self.num_processed[m]*self.minimums
-                                    + minimums)/(self.num_processed[m] + 1.0)
-                self.maximums[m] = (self.num_processed[m]*self.maximums
-                                    + maximums)/(self.num_processed[m] + 1.0)
+            if m not in self.minimums:
+                self.minimums[m] = RunningMoments()
+                self.maximums[m] = RunningMoments()
+            self.minimums[m].update(stats.minimums)
+            self.maximums[m].update(stats.maximums)
             self.num_processed[m] = self.num_processed[m] + 1
             self.num_disruptive[m] = (self.num_disruptive[m]
                                       + (1 if stats.is_disruptive else 0))
 
+    def get_offsets_and_scales(self, machine):
+        assert machine in self.minimums and machine in self.maximums
+        minimums = self.minimums[machine].mean
+        return minimums, self.maximums[machine].mean - minimums
+
     def apply(self, shot):
-        apply_positivity(shot)
-        assert self.minimums is not None and self.maximums is not None
-        m = shot.machine
-        curr_range = (self.maximums[m] - self.minimums[m])
-        if curr_range == 0.0:
-            curr_range = 1.0
-        shot.signals = (shot.signals - self.minimums[m])/curr_range
-        for (i, sig) in enumerate(shot.signals):
-            if sig.normalize:
-                shot.signals_dict[sig] = (
-                    shot.signals_dict[sig] - self.minimums[m])/(
-                        self.maximums[m] - self.minimums[m])
-                shot.signals_dict[sig] = np.clip(
-                    shot.signals_dict[sig], -self.bound, self.bound)
+        self.apply_coefficients(shot)
         shot.ttd = self.remapper(shot.ttd, self.conf['data']['T_warning'])
         self.cut_end_of_shot(shot)
         # self.apply_positivity_mask(shot)
@@ -454,17 +572,41 @@ class MinMaxNormalizer(Normalizer):
     def load_stats(self, verbose=False):
         assert self.previously_saved_stats()[0]
         dat = np.load(self.path, encoding="latin1", allow_pickle=True)
-        self.minimums = dat['minimums'][()]
-        self.maximums = dat['maximums'][()]
         self.num_processed = dat['num_processed'][()]
         self.num_disruptive = dat['num_disruptive'][()]
+        # files saved before the running moments hold the averages only
+        self.minimums = {
+            m: as_running_moments(v, self.num_processed[m])
+            for (m, v) in dat['minimums'][()].items()}
+        self.maximums = {
+            m: as_running_moments(v, self.num_processed[m])
+            for (m, v) in dat['maximums'][()].items()}
         self.machines = dat['machines'][()]
+        self.coefficients = dict()
         # for machine in self.means:
         #     g.print_unique('Machine {}:'.format(machine))
         if verbose:
             self.print_summary()
 
 
+def as_quantile_sketch(value):
+    if isinstance(value, QuantileSketch):
+        return value
+    # legacy rows are kept exactly, so that loading them does not change
+    # their median
+    rows = np.atleast_2d(value)
+    return QuantileSketch.from_rows(rows, k=max(256, rows.shape[0]))
+
+
+def as_running_moments(value, count):
+    if isinstance(value, RunningMoments):
+        return value
+    moments = RunningMoments(len(value))
+    moments.count = count
+    moments.mean = np.array(value, dtype=np.float64)
+    return moments
+
+
 def apply_positivity(shot):
     # if shot.signals_dict is None:
     #     print(shot)
@@ -20,13 +20,19 @@ import pathos.multiprocessing as mp
 
 from plasma.utils.processing import append_to_filename
 from plasma.utils.diagnostics import print_shot_list_sizes
-from plasma.primitives.shots import ShotList
+from plasma.primitives.shots import ShotList, ShotMetadataIndex
+from plasma.primitives.dataset import ShotDataset
 from plasma.utils.downloading import mkdirdepth
+from plasma.utils.hashing import myhash
 
 
 class Preprocessor(object):
-    def __init__(self, conf):
+    def __init__(self, conf, normalizer=None):
         self.conf = conf
+        self.num_processed = 0
+        # if set, normalizer stats are extracted by the preprocessing workers
+        self.normalizer = normalizer
+        self.stats_machines = None
 
     def clean_shot_lists(self):
         shot_list_dir = self.conf['paths']['shot_list_dir']
@@ -49,10 +55,14 @@ class Preprocessor(object):
             print('deleting old file: {}'.format(path))
             os.remove(path)
 
+    def is_incremental(self):
+        return ('incremental_preprocessing' in self.conf['data']
+                and self.conf['data']['incremental_preprocessing'])
+
     def all_are_preprocessed(self):
         return os.path.isfile(self.get_shot_list_path())
 
-    def preprocess_all(self):
+    def preprocess_all(self, distributed=False):
         conf = self.conf
         shot_files_all = conf['paths']['shot_files_all']
         # shot_files_train = conf['paths']['shot_files']
@@ -72,34 +82,196 @@ class Preprocessor(object):
         #     + self.preprocess_from_files(shot_list_dir,
         #      shot_files_test,machines_train,use_shots_test)
         # else:
-        return self.preprocess_from_files(shot_files_all, use_shots)
+        return self.preprocess_from_files(shot_files_all, use_shots,
+                                          distributed)
+
+    def get_num_local_processes(self, distributed=False):
+        # TODO(KGF): generalize the follwowing line to perform well on
+        # architecutres other than CPUs, e.g. KNLs
+        # min( <desired-maximum-process-count>, max(1,mp.cpu_count()-2) )
+        use_cores = max(1, mp.cpu_count() - 2)
+        if distributed:
+            # share the cores of a node among the MPI ranks placed on it
+            use_cores = max(1, use_cores//g.get_local_size())
+        return use_cores
 
-    def preprocess_from_files(self, shot_files, use_shots):
+    def pick_shots(self, shot_files, use_shots):
         # all shots, including invalid ones
         all_signals = self.conf['paths']['all_signals']
         shot_list = ShotList()
         shot_list.load_from_shot_list_files_objects(shot_files, all_signals)
-        shot_list_picked = shot_list.random_sublist(use_shots)
+        if self.is_incremental():
+            # a subset of the listed shots would either never pick up the
+            # newly added shots or change between refreshes, so all are used
+            if use_shots < len(shot_list):
+                print('Incremental preprocessing uses all {} shots, '.format(
+                    len(shot_list)), 'ignoring use_shots = {}'.format(
+                        use_shots))
+            shot_list.sort()
+            return shot_list
+        return shot_list.random_sublist(use_shots)
 
-        # empty
-        used_shots = ShotList()
+    def get_stats_shot_ids(self):
+        '''Return the ids of the shots whose normalizer stats should be
+        extracted during preprocessing, or None if the normalizer stats are
+        already saved (or no normalizer was given)'''
+        if self.normalizer is None:
+            return None
+        shot_files_use, all_machines = (
+            self.normalizer.get_training_shot_files())
+        previously_saved, machines_to_compute = (
+            self.normalizer.get_machines_to_compute(all_machines))
+        if previously_saved and len(machines_to_compute) == 0:
+            return None
+        if previously_saved:
+            self.normalizer.load_stats(verbose=True)
+        self.stats_machines = machines_to_compute
+        shot_list = ShotList()
+        shot_list.load_from_shot_list_files_objects(
+            shot_files_use, self.conf['paths']['all_signals'])
+        print('computing normalization for machines {} '.format(
+            machines_to_compute), 'during preprocessing')
+        return set([shot.get_id_str() for shot in shot_list
+                    if shot.machine in machines_to_compute])
 
-        # TODO(KGF): generalize the follwowing line to perform well on
-        # architecutres other than CPUs, e.g. KNLs
-        # min( <desired-maximum-process-count>, max(1,mp.cpu_count()-2) )
-        use_cores = max(1, mp.cpu_count() - 2)
-        pool = mp.Pool(use_cores)
-        print('Running in parallel on {} processes'.format(pool._processes))
+    def get_tasks(self, shot_list_picked, metadata, used_shots):
+        '''Return the (shot, recompute, input_hash, extract_stats) arguments
+        of preprocess_single_file() for the shots that must be processed.
+
+        Shots already processed are answered from the metadata index and
+        appended to used_shots instead of being restored by the workers,
+        unless their normalizer stats are needed. In incremental mode,
+        shots whose inputs changed since they were processed are stale and
+        recomputed.
+        '''
+        processed_prepath = self.conf['paths']['processed_prepath']
+        stats_shot_ids = self.get_stats_shot_ids()
+        tasks = []
+        sizes = []
+        num_stale = 0
+        num_stats_only = 0
+        for shot in shot_list_picked:
+            file_stats = shot.get_raw_file_stats(self.conf)
+            input_hash = shot.get_input_hash(self.conf, file_stats)
+            extract_stats = (stats_shot_ids is not None
+                             and shot.get_id_str() in stats_shot_ids)
+            if (not self.conf['data']['recompute'] and shot in metadata
+                    and shot.previously_saved(processed_prepath)):
+                if (not self.is_incremental()
+                        or metadata.is_up_to_date(shot, input_hash)):
+                    if not extract_stats:
+                        metadata.restore(shot)
+                        used_shots.append_if_valid(shot)
+                        continue
+                    num_stats_only += 1
+                    tasks.append((shot, False, input_hash, True))
+                else:
+                    num_stale += 1
+                    tasks.append((shot, True, input_hash, extract_stats))
+            else:
+                tasks.append((shot, None, input_hash, extract_stats))
+            sizes.append(max(1, sum([stat[2] for stat in file_stats])))
+        self.num_processed = len(tasks) - num_stats_only
+        print('{} shots found in metadata index, '.format(
+            len(shot_list_picked) - self.num_processed),
+              '{} to process ({} stale)'.format(self.num_processed,
+                                                num_stale))
+        # longest shots first, so that they do not end up in the tail
+        order = np.argsort(sizes, kind='stable')[::-1]
+        return [tasks[i] for i in order], [sizes[i] for i in order]
+
+    def preprocess_chunk(self, chunk):
         start_time = time.time()
-        for (i, shot) in enumerate(pool.imap_unordered(
-                self.preprocess_single_file, shot_list_picked)):
+        results = [self.preprocess_single_file(*task) for task in chunk]
+        return results, os.getpid(), time.time() - start_time
+
+    def run_tasks(self, tasks, sizes, use_cores, verbose=True):
+        '''Process tasks (sorted by decreasing size) on a local pool.
+
+        Tasks are dispatched in guided chunks (see make_guided_chunks), so
+        the largest shots start first and the many small shots at the end
+        are batched. Returns the results and the busy time of each worker.
+        '''
+        pool = mp.Pool(use_cores)
+        if verbose:
+            print('Running in parallel on {} processes'.format(
+                pool._processes))
+        chunks = make_guided_chunks(tasks, sizes, pool._processes)
+        results = []
+        busy_times = {}
+        for (chunk_results, pid, busy_time) in pool.imap_unordered(
+                self.preprocess_chunk, chunks):
             # for (i,shot) in
             # enumerate(map(self.preprocess_single_file,shot_list_picked)):
-            sys.stdout.write('\r{}/{}'.format(i, len(shot_list_picked)))
-            used_shots.append_if_valid(shot)
-
+            results += chunk_results
+            busy_times[pid] = busy_times.get(pid, 0.0) + busy_time
+            if verbose:
+                sys.stdout.write('\r{}/{}'.format(len(results), len(tasks)))
+        # workers that never received a chunk were idle all along
+        busy_times = list(busy_times.values()) + [0.0]*(
+            pool._processes - len(busy_times))
         pool.close()
         pool.join()
+        return results, busy_times
+
+    def preprocess_from_files(self, shot_files, use_shots, distributed=False):
+        '''Preprocess the shots in shot_files, returning the valid ones.
+
+        With distributed=True, every MPI rank must call this method. Rank 0
+        picks the shots and shards them across the ranks, each of which
+        processes its shard with a local process pool sized to its share
+        of the node. The results are gathered on rank 0, which returns the
+        ShotList; the other ranks return None.
+        '''
+        distributed = distributed and g.comm is not None
+        is_root = not distributed or g.task_index == 0
+        processed_prepath = self.conf['paths']['processed_prepath']
+        tasks = None
+        sizes = None
+        if is_root:
+            shot_list_picked = self.pick_shots(shot_files, use_shots)
+            # empty
+            used_shots = ShotList()
+            metadata = ShotMetadataIndex(processed_prepath)
+            tasks, sizes = self.get_tasks(shot_list_picked, metadata,
+                                          used_shots)
+        start_time = time.time()
+        use_cores = self.get_num_local_processes(distributed)
+        if distributed:
+            tasks, sizes = g.comm.bcast((tasks, sizes), root=0)
+            g.print_unique('Running on {} MPI ranks'.format(g.num_workers))
+            # dealing out the size-sorted tasks balances the shards
+            tasks = tasks[g.task_index::g.num_workers]
+            sizes = sizes[g.task_index::g.num_workers]
+        results, busy_times = self.run_tasks(tasks, sizes, use_cores,
+                                             verbose=is_root)
+        wall_time = time.time() - start_time
+        if distributed:
+            gathered = g.comm.gather((results, busy_times, wall_time),
+                                     root=0)
+            if not is_root:
+                return None
+            results = [r for (rank_results, _, _) in gathered
+                       for r in rank_results]
+            busy_times = [rank_busy_times
+                          for (_, rank_busy_times, _) in gathered]
+            wall_time = max([rank_wall_time
+                             for (_, _, rank_wall_time) in gathered])
+        else:
+            busy_times = [busy_times]
+        print_worker_utilization(busy_times, wall_time)
+
+        for (shot, record, stats) in results:
+            metadata.update(shot, record)
+            used_shots.append_if_valid(shot)
+            if stats is not None and stats.machine in self.stats_machines:
+                self.normalizer.incorporate_stats(stats)
+                self.normalizer.machines.add(stats.machine)
+        if len(results) > 0:
+            metadata.save()
+        if self.stats_machines is not None:
+            self.normalizer.save_stats(verbose=True)
+            self.normalizer.stats_up_to_date = True
         print('\nFinished preprocessing {} files in {} seconds'.format(
             len(shot_list_picked), time.time() - start_time))
         print('Using {} shots ({} disruptive shots)'.format(
@@ -118,24 +290,33 @@ class Preprocessor(object):
                       self.conf['paths']['signal_prepath']))
         return used_shots
 
-    def preprocess_single_file(self, shot):
+    def preprocess_single_file(self, shot, recompute=None, input_hash=None,
+                               extract_stats=False):
         processed_prepath = self.conf['paths']['processed_prepath']
-        recompute = self.conf['data']['recompute']
+        if recompute is None:
+            recompute = self.conf['data']['recompute']
         # print('({}/{}): '.format(num_processed,use_shots))
         if recompute or not shot.previously_saved(processed_prepath):
             shot.preprocess(self.conf)
             shot.save(processed_prepath)
         else:
             try:
-                shot.restore(processed_prepath, light=True)
+                # full restore, to index the length of a shot processed
+                # before the metadata index existed
+                shot.restore(processed_prepath)
                 sys.stdout.write('\r{} exists.'.format(shot.number))
             except BaseException:
                 shot.preprocess(self.conf)
                 shot.save(processed_prepath)
                 sys.stdout.write('\r{} exists but corrupted, resaved.'.format(
                     shot.number))
+        record = ShotMetadataIndex.make_record(shot, input_hash)
+        stats = None
+        if extract_stats and shot.valid:
+            # the resampled arrays are still in memory
+            stats = self.normalizer.extract_stats(shot)
         shot.make_light()
-        return shot
+        return shot, record, stats
 
     def get_individual_channel_dirs(self):
         # TODO(KGF): unused
@@ -238,29 +419,184 @@ def apply_bleed_in(conf, shot_list_train, shot_list_validate, shot_list_test):
     return shot_list_train, shot_list_validate, shot_list_test
 
 
-def guarantee_preprocessed(conf, verbose=False):
-    pp = Preprocessor(conf)
-    if pp.all_are_preprocessed():
+def make_guided_chunks(tasks, sizes, num_workers):
+    '''
+    Group tasks, sorted by decreasing size, into chunks for a pool of
+    num_workers. Each chunk holds at most 1/(2*num_workers) of the size still
+    to be scheduled (but at least one task), so the large tasks at the front
+    are dispatched one at a time and the small tasks at the end are batched
+    to amortize the dispatch overhead (guided self-scheduling).
+    '''
+    chunks = []
+    remaining = float(sum(sizes))
+    i = 0
+    while i < len(tasks):
+        max_size = remaining/(2*num_workers)
+        chunk = [tasks[i]]
+        chunk_size = sizes[i]
+        i += 1
+        while i < len(tasks) and chunk_size + sizes[i] <= max_size:
+            chunk.append(tasks[i])
+            chunk_size += sizes[i]
+            i += 1
+        remaining -= chunk_size
+        chunks.append(chunk)
+    return chunks
+
+
+def print_worker_utilization(busy_times, wall_time):
+    '''Summarize the busy time of the pool workers, given as a list (one
+    entry per MPI rank) of lists of per-worker busy times'''
+    busy = np.array([t for rank_busy_times in busy_times
+                     for t in rank_busy_times])
+    if len(busy) == 0 or wall_time <= 0:
+        return
+    utilization = busy/wall_time
+    print('\nWorker utilization over {:.1f}s:'.format(wall_time),
+          'mean {:.1%}, min {:.1%}, max {:.1%}'.format(
+              np.mean(utilization), np.min(utilization),
+              np.max(utilization)),
+          '({} workers on {} ranks)'.format(len(busy), len(busy_times)))
+
+
+def hash_fraction(key):
+    '''Deterministic pseudo-random number in [0, 1) for a str key'''
+    return (myhash(key) % 1000003)/1000003.0
+
+
+def split_deterministic(conf, shot_list, shot_lists_old=None,
+                        validation_frac=None):
+    '''
+    Split shot_list into train, validate and test lists such that each
+    shot is always assigned to the same list.
+
+    Shots present in shot_lists_old (train, validate, test) keep their
+    previous assignment. New shots from the test shot files go to test;
+    otherwise the train/test (if no test files are given) and
+    train/validate assignments are decided by a hash of the shot id, so a
+    refresh only appends shots and never reshuffles existing ones.
+    '''
+    if validation_frac is None:
+        validation_frac = conf['training']['validation_frac']
+    train_frac = conf['training']['train_frac']
+    shot_files_test = conf['paths']['shot_files_test']
+    test_ids = None
+    if len(shot_files_test) > 0:
+        shot_list_test_files = ShotList()
+        shot_list_test_files.load_from_shot_list_files_objects(
+            shot_files_test, conf['paths']['all_signals'])
+        test_ids = set([shot.get_id_str() for shot in shot_list_test_files])
+    old_assignment = {}
+    if shot_lists_old is not None:
+        for (j, shot_list_old) in enumerate(shot_lists_old):
+            for shot in shot_list_old:
+                old_assignment[shot.get_id_str()] = j
+    shot_lists = [ShotList(), ShotList(), ShotList()]
+    for shot in shot_list:
+        id_str = shot.get_id_str()
+        if id_str in old_assignment:
+            j = old_assignment[id_str]
+        elif test_ids is not None and id_str in test_ids:
+            j = 2
+        elif test_ids is None and hash_fraction(id_str + ' test') >= (
+                train_frac):
+            j = 2
+        elif hash_fraction(id_str + ' validate') < validation_frac:
+            j = 1
+        else:
+            j = 0
+        shot_lists[j].append(shot)
+    if shot_lists_old is not None:
+        print('{} shots added to the existing split'.format(
+            len([s for s in shot_list
+                 if s.get_id_str() not in old_assignment])))
+    return tuple(shot_lists)
+
+
+def guarantee_preprocessed(conf, verbose=False, distributed=False,
+                           normalizer=None, update=True):
+    '''Make sure all shots are preprocessed and return the shot lists.
+
+    With distributed=True, all MPI ranks must call this function and share
+    the preprocessing work (see Preprocessor.preprocess_from_files); rank 0
+    splits and saves the shot lists, which the other ranks then load.
+
+    If a normalizer is given and its stats are not saved yet, the stats are
+    extracted by the preprocessing workers from the training shots and
+    saved, so that normalizer.train() only has to load them.
+
+    With incremental preprocessing, the saved shot lists are updated with
+    the new and changed shots; update=False loads them as they are instead
+    (e.g. in a second call of the same run, right after the update).
+    '''
+    pp = Preprocessor(conf, normalizer)
+    distributed = distributed and g.comm is not None
+    is_root = not distributed or g.task_index == 0
+    done = pp.all_are_preprocessed() and not (pp.is_incremental()
+                                              and update)
+    if distributed:
+        done = g.comm.bcast(done, root=0)
+    if done:
         if verbose:
             g.print_unique("shots already processed.")
         (shot_list_train, shot_list_validate,
          shot_list_test) = pp.load_shotlists()
     else:
-        if verbose:
-            g.print_unique("preprocessing all shots...")  # , end='')
-        pp.clean_shot_lists()
-        shot_list = pp.preprocess_all()
-        shot_list.sort()
-        shot_list_train, shot_list_test = shot_list.split_train_test(conf)
-        # num_shots = len(shot_list_train) + len(shot_list_test)
-        validation_frac = conf['training']['validation_frac']
-        if validation_frac <= 0.05:
+        shot_lists_old = None
+        if is_root:
+            if conf['data']['recompute']:
+                # every shot is saved again, so the dataset is stale
+                ShotDataset.remove(ShotDataset.get_prepath(conf))
+            if pp.all_are_preprocessed():
+                if verbose:
+                    g.print_unique("updating processed shots...")
+                shot_lists_old = pp.load_shotlists()
+            elif verbose:
+                g.print_unique("preprocessing all shots...")  # , end='')
+            pp.clean_shot_lists()
+        if distributed:
+            g.comm.Barrier()
+        shot_list = pp.preprocess_all(distributed)
+        if is_root:
+            shot_list.sort()
+            validation_frac = conf['training']['validation_frac']
+            if validation_frac <= 0.05:
+                if verbose:
+                    g.print_unique('Setting validation to a minimum of 0.05')
+                validation_frac = 0.05
+            if pp.is_incremental():
+                (shot_list_train, shot_list_validate,
+                 shot_list_test) = split_deterministic(
+                     conf, shot_list, shot_lists_old, validation_frac)
+            else:
+                shot_list_train, shot_list_test = shot_list.split_train_test(
+                    conf)
+                # num_shots = len(shot_list_train) + len(shot_list_test)
+                shot_list_train, shot_list_validate = (
+                    shot_list_train.split_direct(1.0-validation_frac,
+                                                 do_shuffle=True))
+            pp.save_shotlists(shot_list_train, shot_list_validate,
+                              shot_list_test)
+        if distributed:
+            g.comm.Barrier()
+            if not is_root:
+                (shot_list_train, shot_list_validate,
+                 shot_list_test) = pp.load_shotlists()
+    dataset_prepath = ShotDataset.get_prepath(conf)
+    if is_root and ShotDataset.is_enabled(conf):
+        shot_list_all = shot_list_train + shot_list_validate + shot_list_test
+        # shots may also have been saved again outside of this function
+        if (pp.num_processed > 0
+                or not ShotDataset.previously_saved(dataset_prepath)
+                or not ShotDataset(dataset_prepath).is_up_to_date(
+                    shot_list_all, conf['paths']['processed_prepath'])):
             if verbose:
-                g.print_unique('Setting validation to a minimum of 0.05')
-            validation_frac = 0.05
-        shot_list_train, shot_list_validate = shot_list_train.split_direct(
-            1.0-validation_frac, do_shuffle=True)
-        pp.save_shotlists(shot_list_train, shot_list_validate, shot_list_test)
+                g.print_unique("consolidating processed shots...")
+            ShotDataset.build(shot_list_all,
+                              conf['paths']['processed_prepath'],
+                              dataset_prepath, conf['data']['floatx'])
+    if distributed:
+        g.comm.Barrier()
     shot_list_train, shot_list_validate, shot_list_test = apply_bleed_in(
         conf, shot_list_train, shot_list_validate, shot_list_test)
     if verbose:
@@ -4,9 +4,8 @@ import sys
 import os
 import re
 
-from scipy.interpolate import UnivariateSpline
-from plasma.utils.processing import get_individual_shot_file
-from plasma.utils.downloading import get_missing_value_array
+from plasma.utils.processing import get_raw_signal_file, remap_profiles
+from plasma.utils.downloading import get_missing_value_array, load_raw_signal
 from plasma.utils.hashing import myhash
 
 # class SignalCollection:
@@ -49,11 +48,10 @@ class Signal(object):
     def is_ip(self):
         return self.is_ip
 
-    def get_file_path(self, prepath, machine, shot_number):
+    def get_file_path(self, prepath, machine, shot_number, ext=None):
         signal_dirname = self.get_path(machine)
         dirname = os.path.join(prepath, machine.name, signal_dirname)
-        return get_individual_shot_file(dirname, machine.name, shot_number,
-                                        raw_signal=True)
+        return get_raw_signal_file(dirname, machine.name, shot_number, ext)
 
     def is_valid(self, prepath, shot, dtype='float32'):
         t, data, exists = self.load_data(prepath, shot, dtype)
@@ -63,7 +61,7 @@ class Signal(object):
         file_path = self.get_file_path(prepath, shot.machine, shot.number)
         return os.path.isfile(file_path)
 
-    def load_data_from_txt_safe(self, prepath, shot, dtype='float32'):
+    def load_data_from_file_safe(self, prepath, shot, dtype='float32'):
         file_path = self.get_file_path(prepath, shot.machine, shot.number)
         if not self.is_saved(prepath, shot):
             print('Signal {}, shot {} was never downloaded [omit]'.format(
@@ -76,7 +74,7 @@ class Signal(object):
             os.remove(file_path)
             return None, False
         try:
-            data = np.loadtxt(file_path, dtype=dtype)
+            data = load_raw_signal(file_path, dtype=dtype)
             if np.all(data == get_missing_value_array()):
                 print('Signal {}, shot {} contains no data [omit]'.format(
                     self.description, shot.number))
@@ -91,7 +89,7 @@ class Signal(object):
         return data, True
 
     def load_data(self, prepath, shot, dtype='float32'):
-        data, succ = self.load_data_from_txt_safe(prepath, shot)
+        data, succ = self.load_data_from_file_safe(prepath, shot)
         if not succ:
             return None, None, False
 
@@ -227,7 +225,7 @@ class ProfileSignal(Signal):
         self.num_channels = num_channels
 
     def load_data(self, prepath, shot, dtype='float32'):
-        data, succ = self.load_data_from_txt_safe(prepath, shot)
+        data, succ = self.load_data_from_file_safe(prepath, shot)
         if not succ:
             return None, None, False
 
@@ -256,23 +254,12 @@ class ProfileSignal(Signal):
                   'contains NaN value(s) [omit]')
             return None, None, False
 
-        timesteps = len(t)
-        sig_interp = np.zeros((timesteps, self.num_channels))
-        for i in range(timesteps):
-            # make sure the mapping is ordered and unique
-            _, order = np.unique(mapping[i, :], return_index=True)
-            if sig[i, order].shape[0] > 2:
-                # ext = 0 is extrapolation, ext = 3 is boundary value.
-                f = UnivariateSpline(mapping[i, order], sig[i, order], s=0,
-                                     k=1, ext=3)
-                sig_interp[i, :] = f(remapping)
-            else:
-                print('Signal {}, shot {} '.format(self.description,
-                                                   shot.number),
-                      'has insufficient points for linear interpolation. ',
-                      'dfitpack.error: (m>k) failed for hidden m: fpcurf0:m=1 '
-                      '[omit]')
-                return None, None, False
+        sig_interp, valid = remap_profiles(mapping, sig, remapping)
+        if not np.all(valid):
+            print('Signal {}, shot {} '.format(self.description, shot.number),
+                  'has insufficient points for linear interpolation in ',
+                  '{} of {} timesteps [omit]'.format(np.sum(~valid), len(t)))
+            return None, None, False
 
         return t, sig_interp, True
 
@@ -358,15 +345,14 @@ class ChannelSignal(Signal):
                 data = data[channel_num, :]  # extract channel of interest
         return time, data, mapping, success
 
-    def get_file_path(self, prepath, machine, shot_number):
+    def get_file_path(self, prepath, machine, shot_number, ext=None):
         signal_dirname = self.get_path(machine)
         num = self.get_channel_num(machine)
         if num is not None:
             # TODO(KGF): deduplicate with parent class fn. Only difference:
             signal_dirname += "/channel{}".format(num)
         dirname = os.path.join(prepath, machine.name, signal_dirname)
-        return get_individual_shot_file(dirname, machine.name, shot_number,
-                                        raw_signal=True)
+        return get_raw_signal_file(dirname, machine.name, shot_number, ext)
 
 
 class Machine(object):
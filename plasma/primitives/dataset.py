@@ -0,0 +1,251 @@
+'''
+#########################################################
+This file contains the consolidated, memory-mapped format for processed shots
+
+Instead of one pickled .npz per shot, every signal is stored as a single
+contiguous raw array (rows = timesteps of all shots that have the signal,
+columns = channels), plus one array for the ttd of all shots. An index file
+records, for each shot, its number, machine, length, flags and row offsets.
+Shots and any subset of their signals are then restored as zero-copy views
+into np.memmap arrays, without unpickling anything.
+#########################################################
+'''
+
+from __future__ import print_function
+import os
+import shutil
+
+import numpy as np
+
+from plasma.utils.downloading import makedirs_process_safe
+from plasma.utils.hashing import myhash
+
+
+class ShotDataset(object):
+    index_filename = 'index.npz'
+    ttd_filename = 'ttd.bin'
+
+    def __init__(self, prepath):
+        self.prepath = prepath
+        index = np.load(os.path.join(prepath, self.index_filename))
+        self.dtype = np.dtype(str(index['dtype']))
+        self.numbers = index['numbers']
+        self.machines = index['machines']
+        self.lengths = index['lengths']
+        self.valid = index['valid']
+        self.is_disruptive = index['is_disruptive']
+        self.ttd_offsets = index['ttd_offsets']
+        # (num_shots, num_signals), -1 where a shot does not have the signal
+        self.offsets = index['offsets']
+        self.signal_keys = list(index['signal_keys'])
+        self.num_channels = index['num_channels']
+        self.num_rows = index['num_rows']
+        # modification times of the per-shot files, absent in old datasets
+        self.shot_mtimes = (index['shot_mtimes']
+                            if 'shot_mtimes' in index.files else None)
+        self.shot_rows = {
+            (str(m), int(n)): i for (i, (m, n)) in enumerate(
+                zip(self.machines, self.numbers))}
+        self.signal_columns = {
+            k: j for (j, k) in enumerate(self.signal_keys)}
+        self.memmaps = {}
+
+    def __len__(self):
+        return len(self.numbers)
+
+    def __contains__(self, shot):
+        return self.get_shot_row(shot) is not None
+
+    def __getstate__(self):
+        # memory maps are reopened lazily in the receiving process
+        state = self.__dict__.copy()
+        state['memmaps'] = {}
+        return state
+
+    @staticmethod
+    def get_signal_key(signal):
+        return str(myhash(signal.description_plus_paths()))
+
+    @staticmethod
+    def get_signal_filename(key):
+        return 'signal_{}.bin'.format(key)
+
+    @staticmethod
+    def get_prepath(conf):
+        return conf['paths']['processed_prepath'] + 'dataset/'
+
+    @staticmethod
+    def is_enabled(conf):
+        return ('use_consolidated_dataset' in conf['data']
+                and conf['data']['use_consolidated_dataset'])
+
+    @classmethod
+    def previously_saved(cls, prepath):
+        return os.path.isfile(os.path.join(prepath, cls.index_filename))
+
+    @staticmethod
+    def remove(prepath):
+        if os.path.isdir(prepath):
+            shutil.rmtree(prepath)
+
+    def is_up_to_date(self, shot_list, shot_prepath):
+        '''True if every shot of shot_list is in the dataset, and its
+        per-shot file under shot_prepath was not saved again since the
+        dataset was built'''
+        if self.shot_mtimes is None:
+            return False
+        for shot in shot_list:
+            i = self.get_shot_row(shot)
+            if i is None:
+                return False
+            path = shot.get_save_path(shot_prepath)
+            if (not os.path.isfile(path)
+                    or os.path.getmtime(path) > self.shot_mtimes[i]):
+                return False
+        return True
+
+    def get_memmap(self, filename, num_rows, num_channels=None):
+        if filename not in self.memmaps:
+            path = os.path.join(self.prepath, filename)
+            shape = ((num_rows,) if num_channels is None
+                     else (num_rows, num_channels))
+            if num_rows == 0:
+                self.memmaps[filename] = np.zeros(shape, dtype=self.dtype)
+            else:
+                self.memmaps[filename] = np.memmap(
+                    path, dtype=self.dtype, mode='r', shape=shape)
+        return self.memmaps[filename]
+
+    def get_shot_row(self, shot):
+        return self.shot_rows.get((str(shot.machine), int(shot.number)))
+
+    def get_ttd(self, shot):
+        i = self.get_shot_row(shot)
+        arr = self.get_memmap(self.ttd_filename, self.num_rows[-1])
+        start = self.ttd_offsets[i]
+        return arr[start:start + self.lengths[i]]
+
+    def get_signal(self, shot, signal):
+        i = self.get_shot_row(shot)
+        key = self.get_signal_key(signal)
+        j = self.signal_columns[key]
+        start = self.offsets[i, j]
+        assert start >= 0, 'signal {} not stored for shot {}'.format(
+            signal, shot.number)
+        arr = self.get_memmap(self.get_signal_filename(key),
+                              self.num_rows[j], self.num_channels[j])
+        return arr[start:start + self.lengths[i]]
+
+    def restore(self, shot, use_signals=None, light=False):
+        '''Drop-in replacement for Shot.restore(). The arrays placed in
+        signals_dict are read-only views; defaults to all of shot.signals'''
+        i = self.get_shot_row(shot)
+        assert i is not None, 'shot {} not in dataset'.format(shot.number)
+        shot.valid = self.valid[i]
+        shot.is_disruptive = self.is_disruptive[i]
+        if light:
+            shot.signals_dict = None
+            shot.ttd = None
+            return
+        if use_signals is None:
+            use_signals = shot.signals
+        shot.signals_dict = {sig: self.get_signal(shot, sig)
+                             for sig in use_signals}
+        shot.ttd = self.get_ttd(shot)
+
+    def get_data_arrays(self, shot, use_signals):
+        '''Equivalent of Shot.get_data_arrays() for an unnormalized shot'''
+        ttd = self.get_ttd(shot)
+        signal_array = np.concatenate(
+            [self.get_signal(shot, sig) for sig in use_signals], axis=1)
+        return ttd, signal_array
+
+    @classmethod
+    def build(cls, shot_list, shot_prepath, prepath, dtype='float32'):
+        '''Consolidate the per-shot .npz files under shot_prepath.
+
+        Arrays are appended shot by shot, so memory usage is bounded by a
+        single shot. Files are written to a temporary directory which is
+        renamed into place at the end, so a dataset at prepath is always
+        complete.
+        '''
+        tmp_prepath = prepath.rstrip('/') + '.tmp/'
+        if os.path.isdir(tmp_prepath):
+            shutil.rmtree(tmp_prepath)
+        makedirs_process_safe(tmp_prepath)
+        dtype = np.dtype(dtype)
+
+        shots = []
+        ids = set()
+        for shot in shot_list:
+            if shot.get_id_str() not in ids:
+                ids.add(shot.get_id_str())
+                shots.append(shot)
+        shot_list = shots
+        signals = []
+        for shot in shot_list:
+            for sig in shot.signals:
+                if sig not in signals:
+                    signals.append(sig)
+        signal_keys = [cls.get_signal_key(sig) for sig in signals]
+        num_channels = np.array([sig.num_channels for sig in signals],
+                                dtype=np.int64)
+        num_shots = len(shot_list)
+        numbers = np.zeros(num_shots, dtype=np.int64)
+        machines = []
+        lengths = np.zeros(num_shots, dtype=np.int64)
+        valid = np.zeros(num_shots, dtype=bool)
+        is_disruptive = np.zeros(num_shots, dtype=bool)
+        ttd_offsets = np.zeros(num_shots, dtype=np.int64)
+        shot_mtimes = np.zeros(num_shots, dtype=np.float64)
+        offsets = -np.ones((num_shots, len(signals)), dtype=np.int64)
+        # last entry counts the rows of the ttd array
+        num_rows = np.zeros(len(signals) + 1, dtype=np.int64)
+
+        files = [open(os.path.join(tmp_prepath, cls.get_signal_filename(k)),
+                      'wb') for k in signal_keys]
+        ttd_file = open(os.path.join(tmp_prepath, cls.ttd_filename), 'wb')
+        try:
+            for (i, shot) in enumerate(shot_list):
+                shot_mtimes[i] = os.path.getmtime(
+                    shot.get_save_path(shot_prepath))
+                shot.restore(shot_prepath)
+                length = len(shot.ttd)
+                numbers[i] = shot.number
+                machines.append(str(shot.machine))
+                lengths[i] = length
+                valid[i] = shot.valid
+                is_disruptive[i] = shot.is_disruptive
+                ttd_offsets[i] = num_rows[-1]
+                ttd_file.write(np.ascontiguousarray(
+                    np.reshape(shot.ttd, (length,)), dtype=dtype).tobytes())
+                num_rows[-1] += length
+                for sig in shot.signals:
+                    j = signals.index(sig)
+                    arr = shot.signals_dict[sig]
+                    assert arr.shape == (length, num_channels[j])
+                    offsets[i, j] = num_rows[j]
+                    files[j].write(np.ascontiguousarray(
+                        arr, dtype=dtype).tobytes())
+                    num_rows[j] += length
+                shot.make_light()
+        finally:
+            for f in files + [ttd_file]:
+                f.close()
+
+        np.savez(os.path.join(tmp_prepath, cls.index_filename),
+                 dtype=dtype.str, numbers=numbers,
+                 machines=np.array(machines, dtype=str), lengths=lengths,
+                 valid=valid, is_disruptive=is_disruptive,
+                 ttd_offsets=ttd_offsets, offsets=offsets,
+                 signal_keys=np.array(signal_keys, dtype=str),
+                 signal_descriptions=np.array(
+                     [sig.description for sig in signals], dtype=str),
+                 num_channels=num_channels, num_rows=num_rows,
+                 shot_mtimes=shot_mtimes)
+        if os.path.isdir(prepath):
+            shutil.rmtree(prepath)
+        os.rename(tmp_prepath.rstrip('/'), prepath.rstrip('/'))
+        print('Consolidated {} shots ({} timesteps) into {}'.format(
+            num_shots, num_rows[-1], prepath))
+        return cls(prepath)
@@ -1,3 +1,5 @@
+import abc
+
 import numpy as np
 from mpi4py import MPI
 comm = MPI.COMM_WORLD
@@ -16,3 +18,355 @@ def sum_f16_cb(buffer_a, buffer_b, t):
 
 # create new OP
 mpi_sum_f16 = MPI.Op.Create(sum_f16_cb, commute=True)
+
+
+class GradientBuckets(object):
+    '''
+    Preallocated contiguous buffers for reducing a list of arrays (e.g. the
+    weight deltas of all layers of a model) in as few collectives as
+    possible.
+
+    The arrays are packed in order into buckets of at most bucket_nbytes
+    bytes (a single bucket if None; an array larger than the cap gets a
+    bucket of its own). Each bucket is reduced with one Allreduce (or
+    Iallreduce, to overlap the reduction with other work), and the
+    results are returned as views into the receive buffers, which are
+    overwritten by the next reduction. A GradientCompressor or a
+    HierarchicalAllreduce can be passed to reduce every bucket with it
+    instead.
+    '''
+
+    def __init__(self, shapes, dtype, bucket_nbytes=None):
+        self.shapes = [tuple(shape) for shape in shapes]
+        self.dtype = np.dtype(dtype)
+        sizes = [int(np.prod(shape)) for shape in self.shapes]
+        max_size = None
+        if bucket_nbytes:
+            max_size = max(1, bucket_nbytes//self.dtype.itemsize)
+        # (bucket index, offset) of every array
+        self.locations = []
+        bucket_sizes = []
+        for size in sizes:
+            if (len(bucket_sizes) == 0 or (
+                    max_size is not None and bucket_sizes[-1] > 0
+                    and bucket_sizes[-1] + size > max_size)):
+                bucket_sizes.append(0)
+            self.locations.append((len(bucket_sizes) - 1, bucket_sizes[-1]))
+            bucket_sizes[-1] += size
+        self.send_buffers = [np.empty(n, dtype=self.dtype)
+                             for n in bucket_sizes]
+        self.recv_buffers = [np.empty(n, dtype=self.dtype)
+                             for n in bucket_sizes]
+        self.outputs = [
+            self.recv_buffers[b][offset:offset + size].reshape(shape)
+            for ((b, offset), size, shape) in zip(
+                self.locations, sizes, self.shapes)]
+
+    @classmethod
+    def from_arrays(cls, arrays, bucket_nbytes=None):
+        return cls([np.shape(arr) for arr in arrays],
+                   np.result_type(*arrays), bucket_nbytes)
+
+    def matches(self, arrays):
+        return (len(arrays) == len(self.shapes)
+                and np.result_type(*arrays) == self.dtype
+                and all([np.shape(arr) == shape for (arr, shape) in zip(
+                    arrays, self.shapes)]))
+
+    def get_op(self):
+        return mpi_sum_f16 if self.dtype == np.float16 else MPI.SUM
+
+    def pack(self, arrays):
+        for (arr, (b, offset)) in zip(arrays, self.locations):
+            size = np.size(arr)
+            self.send_buffers[b][offset:offset + size] = np.ravel(arr)
+
+    def zero(self):
+        for buff in self.send_buffers:
+            buff.fill(0)
+
+    def average(self, num_replicas):
+        for buff in self.recv_buffers:
+            buff /= num_replicas
+
+    def allreduce(self, comm, compressor=None):
+        if compressor is not None:
+            for (b, (send, recv)) in enumerate(zip(self.send_buffers,
+                                                   self.recv_buffers)):
+                compressor.allreduce(comm, send, recv, key=b)
+            return list(self.outputs)
+        op = self.get_op()
+        for (send, recv) in zip(self.send_buffers, self.recv_buffers):
+            comm.Allreduce(send, recv, op=op)
+        return list(self.outputs)
+
+    def bcast(self, reducer):
+        '''Broadcast the packed arrays of rank 0 with reducer.bcast, and
+        return them as views (as for allreduce)'''
+        for (send, recv) in zip(self.send_buffers, self.recv_buffers):
+            recv[:] = send
+            reducer.bcast(recv)
+        return list(self.outputs)
+
+    def start_allreduce(self, comm, compressor=None):
+        '''Non-blocking allreduce: returns one request per bucket. The
+        buffers must not be touched before all requests have completed,
+        after which the results are in self.outputs. Compressed reductions
+        are blocking, and return no requests'''
+        if compressor is not None:
+            self.allreduce(comm, compressor)
+            return []
+        op = self.get_op()
+        return [comm.Iallreduce(send, recv, op=op)
+                for (send, recv) in zip(self.send_buffers, self.recv_buffers)]
+
+
+class GradientCompressor(object):
+    '''
+    Sum of a buffer over all ranks of comm, with a plain Allreduce.
+
+    Subclasses reduce fewer bytes, at the cost of precision. They only use
+    built-in MPI datatypes and collectives, and sum in float32 with numpy,
+    instead of calling a Python reduction op (like mpi_sum_f16) from MPI.
+    '''
+
+    def allreduce(self, comm, send, recv, key=0):
+        '''Write the sum of send over comm into recv. key identifies the
+        buffer, for compressors that keep state between reductions'''
+        op = mpi_sum_f16 if send.dtype == np.float16 else MPI.SUM
+        comm.Allreduce(send, recv, op=op)
+
+    def get_nbytes_sent(self, size, num_workers, itemsize=4):
+        '''Bytes sent by each rank to reduce size elements, assuming a
+        bandwidth-optimal (ring) Allreduce'''
+        return int(2*(num_workers - 1)*size*itemsize//num_workers)
+
+
+class HalfPrecisionCompressor(GradientCompressor, metaclass=abc.ABCMeta):
+    '''
+    Ring allreduce with 16 bit transport and float32 accumulation.
+
+    The buffer is split in one chunk per rank. In a reduce-scatter of
+    num_workers - 1 steps, each rank sends an encoded partial sum of one
+    chunk to the next rank, and adds the decoded chunk received from the
+    previous one. The fully reduced chunks are then encoded once more and
+    allgathered, so all ranks decode the same result. Buffers of any shape
+    are reduced as flat arrays.
+    '''
+
+    @abc.abstractmethod
+    def encode(self, arr):
+        '''uint16 encoding of the float32 array arr'''
+        pass
+
+    @abc.abstractmethod
+    def decode(self, arr):
+        '''float32 array encoded by encode as the uint16 array arr'''
+        pass
+
+    def allreduce(self, comm, send, recv, key=0):
+        num_workers = comm.Get_size()
+        rank = comm.Get_rank()
+        acc = np.ravel(send).astype(np.float32)
+        if num_workers == 1:
+            recv[...] = acc.reshape(recv.shape)
+            return
+        bounds = np.linspace(0, len(acc), num_workers + 1).astype(int)
+        chunks = [slice(bounds[i], bounds[i + 1])
+                  for i in range(num_workers)]
+        recv_buff = np.empty(np.max(np.diff(bounds)), dtype=np.uint16)
+        right = (rank + 1) % num_workers
+        left = (rank - 1) % num_workers
+        for step in range(num_workers - 1):
+            send_chunk = chunks[(rank - step) % num_workers]
+            recv_chunk = chunks[(rank - step - 1) % num_workers]
+            num_recv = recv_chunk.stop - recv_chunk.start
+            comm.Sendrecv(self.encode(acc[send_chunk]), dest=right,
+                          recvbuf=recv_buff[:num_recv], source=left)
+            acc[recv_chunk] += self.decode(recv_buff[:num_recv])
+        # rank r now holds the sum of chunk r + 1
+        owners = [(r + 1) % num_workers for r in range(num_workers)]
+        gathered = np.empty(len(acc), dtype=np.uint16)
+        comm.Allgatherv(
+            self.encode(acc[chunks[owners[rank]]]),
+            [gathered, np.diff(bounds)[owners], bounds[:-1][owners],
+             MPI.UINT16_T])
+        recv[...] = self.decode(gathered).reshape(recv.shape)
+
+    def get_nbytes_sent(self, size, num_workers, itemsize=4):
+        return super(HalfPrecisionCompressor, self).get_nbytes_sent(
+            size, num_workers, 2)
+
+
+class Float16Compressor(HalfPrecisionCompressor):
+    '''IEEE half precision transport. Partial sums above 65504 overflow'''
+
+    def encode(self, arr):
+        return arr.astype(np.float16).view(np.uint16)
+
+    def decode(self, arr):
+        return arr.view(np.float16).astype(np.float32)
+
+
+class BFloat16Compressor(HalfPrecisionCompressor):
+    '''
+    bfloat16 transport: the upper 16 bits of a float32, rounded to nearest
+    even. Same range as float32, but only 8 bits of mantissa
+    '''
+
+    def encode(self, arr):
+        bits = np.ascontiguousarray(arr, dtype=np.float32).view(np.uint32)
+        rounding = np.uint32(0x7FFF) + ((bits >> 16) & np.uint32(1))
+        return ((bits + rounding) >> 16).astype(np.uint16)
+
+    def decode(self, arr):
+        return (arr.astype(np.uint32) << 16).view(np.float32)
+
+
+class TopKCompressor(GradientCompressor):
+    '''
+    Top-k sparsification with error feedback.
+
+    Each rank only sends the ratio*size entries of largest magnitude of its
+    buffer, as (index, float32 value) pairs gathered by all ranks and summed
+    into a dense result. What was not sent is kept as a residual per key and
+    added to the next buffer with the same key, so that every update is
+    eventually applied. Buffers of any shape are reduced as flat arrays.
+    '''
+
+    def __init__(self, ratio=0.01):
+        assert 0 < ratio <= 1, 'top-k ratio must be in (0, 1]'
+        self.ratio = ratio
+        self.residuals = {}
+
+    def get_k(self, size):
+        return min(size, max(1, int(self.ratio*size)))
+
+    def allreduce(self, comm, send, recv, key=0):
+        num_workers = comm.Get_size()
+        corrected = np.ravel(send).astype(np.float32)
+        residual = self.residuals.get(key)
+        if residual is not None and residual.shape == corrected.shape:
+            corrected += residual
+        k = self.get_k(len(corrected))
+        indices = np.argpartition(np.abs(corrected), -k)[-k:].astype(
+            np.int32)
+        values = corrected[indices]
+        corrected[indices] = 0.0
+        self.residuals[key] = corrected
+        all_indices = np.empty(k*num_workers, dtype=np.int32)
+        all_values = np.empty(k*num_workers, dtype=np.float32)
+        comm.Allgather(indices, all_indices)
+        comm.Allgather(values, all_values)
+        recv[...] = np.bincount(all_indices, weights=all_values,
+                                minlength=recv.size).reshape(recv.shape)
+
+    def get_nbytes_sent(self, size, num_workers, itemsize=4):
+        # index and value of the k entries, to each of the other ranks
+        return (num_workers - 1)*self.get_k(size)*(4 + 4)
+
+
+def get_gradient_compressor(name, topk_ratio=0.01):
+    compressors = {'float16': Float16Compressor,
+                   'bfloat16': BFloat16Compressor,
+                   'topk': lambda: TopKCompressor(topk_ratio)}
+    assert name in compressors, 'unknown gradient compression {}'.format(name)
+    return compressors[name]()
+
+
+class HierarchicalAllreduce(object):
+    '''
+    Node-aware allreduce, with the interface of GradientCompressor.
+
+    comm is split into one communicator per shared-memory node, and one
+    between the node leaders (the ranks with the lowest rank on each node).
+    A reduction has three phases:
+    - every rank copies its buffer to its row of a shared-memory window of
+      its node, and sums its own chunk of the columns over all rows,
+    - the leaders allreduce the node sums (with inter_node, a
+      GradientCompressor, if given),
+    - every rank copies the result from the window.
+    Only the leaders communicate between nodes, so inter-node traffic is
+    divided by the number of ranks per node. The allreduce argument comm is
+    unused, the reduction is always over the comm given here. Buffers of
+    any shape are reduced as flat arrays. The reduction is blocking, and
+    the windows must be released with free before MPI is finalized.
+    '''
+
+    def __init__(self, comm, inter_node=None):
+        self.comm = comm
+        self.inter_node = inter_node
+        self.node_comm = comm.Split_type(MPI.COMM_TYPE_SHARED,
+                                         key=comm.Get_rank())
+        self.node_rank = self.node_comm.Get_rank()
+        self.node_size = self.node_comm.Get_size()
+        self.is_leader = self.node_rank == 0
+        # MPI.COMM_NULL on the other ranks
+        self.leader_comm = comm.Split(
+            0 if self.is_leader else MPI.UNDEFINED, key=comm.Get_rank())
+        self.num_nodes = self.node_comm.bcast(
+            self.leader_comm.Get_size() if self.is_leader else None, root=0)
+        self.windows = {}
+
+    def get_shared_array(self, size, dtype):
+        '''(node_size + 1, size) array in a window shared by the node: one
+        row per rank and a last row for the result'''
+        dtype = np.dtype(dtype)
+        if (size, dtype) not in self.windows:
+            shape = (self.node_size + 1, size)
+            nbytes = int(np.prod(shape))*dtype.itemsize
+            win = MPI.Win.Allocate_shared(
+                nbytes if self.is_leader else 0, dtype.itemsize,
+                comm=self.node_comm)
+            buff, _ = win.Shared_query(0)
+            self.windows[(size, dtype)] = (
+                win, np.ndarray(buffer=buff, dtype=dtype, shape=shape))
+        return self.windows[(size, dtype)]
+
+    def free(self):
+        '''Free the shared memory windows (collective over the node). They
+        are allocated again by the next reduction or broadcast'''
+        for (win, _) in self.windows.values():
+            win.Free()
+        self.windows = {}
+
+    def allreduce(self, comm, send, recv, key=0):
+        win, shared = self.get_shared_array(send.size, send.dtype)
+        shared[self.node_rank] = np.ravel(send)
+        win.Fence()
+        bounds = np.linspace(0, send.size, self.node_size + 1).astype(int)
+        chunk = slice(bounds[self.node_rank], bounds[self.node_rank + 1])
+        np.sum(shared[:self.node_size, chunk], axis=0,
+               out=shared[self.node_size, chunk])
+        win.Fence()
+        if self.is_leader:
+            result = shared[self.node_size]
+            if self.inter_node is not None:
+                self.inter_node.allreduce(self.leader_comm, result.copy(),
+                                          result, key)
+            else:
+                op = mpi_sum_f16 if send.dtype == np.float16 else MPI.SUM
+                self.leader_comm.Allreduce(MPI.IN_PLACE, result, op=op)
+        win.Fence()
+        # the result row is only written again after the first fence of
+        # the next reduction or broadcast, which every rank reaches after
+        # this copy
+        recv[...] = shared[self.node_size].reshape(recv.shape)
+
+    def bcast(self, buff):
+        '''In-place broadcast of buff from rank 0 of comm'''
+        win, shared = self.get_shared_array(buff.size, buff.dtype)
+        if self.is_leader:
+            self.leader_comm.Bcast(buff, root=0)
+        win.Fence()
+        if self.is_leader:
+            shared[self.node_size] = np.ravel(buff)
+        win.Fence()
+        if not self.is_leader:
+            buff[...] = shared[self.node_size].reshape(buff.shape)
+
+    def get_nbytes_sent(self, size, num_workers, itemsize=4):
+        '''Bytes sent between nodes by each leader'''
+        reducer = (GradientCompressor() if self.inter_node is None
+                   else self.inter_node)
+        return reducer.get_nbytes_sent(size, self.num_nodes, itemsize)
@@ -16,7 +16,7 @@ import random as rnd
 import numpy as np
 
 from plasma.utils.processing import (
-    train_test_split, cut_and_resample_signal,
+    train_test_split, cut_and_resample_signals,
     get_individual_shot_file
     )
 from plasma.utils.downloading import makedirs_process_safe
@@ -58,6 +58,51 @@ class ShotListFiles(object):
         return np.concatenate(all_shots), np.concatenate(all_disruption_times)
 
 
+class ShotSampler(object):
+    '''
+    Draws shots with probabilities proportional to a set of weights, in
+    O(1) per draw, with Vose's alias method. The tables are built once in
+    O(N) and any number of shots can be drawn in a single batched call.
+    '''
+
+    def __init__(self, shots, weights):
+        weights = np.asarray(weights, dtype=np.float64)
+        assert len(shots) == len(weights) and len(shots) > 0
+        total = np.sum(weights)
+        assert total > 0, 'cannot sample shots with zero total weight'
+        num = len(weights)
+        prob = weights*num/total
+        alias = np.arange(num)
+        small = list(np.where(prob < 1.0)[0])
+        large = list(np.where(prob >= 1.0)[0])
+        while small and large:
+            i = small.pop()
+            j = large.pop()
+            alias[i] = j
+            prob[j] = prob[j] + prob[i] - 1.0
+            if prob[j] < 1.0:
+                small.append(j)
+            else:
+                large.append(j)
+        # whatever is left over has probability 1 up to rounding errors
+        prob[small + large] = 1.0
+        self.shots = list(shots)
+        self.prob = prob
+        self.alias = alias
+
+    def sample_indices(self, size=None):
+        idx = np.random.randint(len(self.prob), size=size)
+        accept = np.random.random_sample(size) < self.prob[idx]
+        return np.where(accept, idx, self.alias[idx])
+
+    def sample(self, size=None):
+        '''Draw a single shot, or a list of size shots'''
+        idx = self.sample_indices(size)
+        if size is None:
+            return self.shots[int(idx)]
+        return [self.shots[i] for i in idx]
+
+
 class ShotList(object):
     '''
     A wrapper class around list of Shot objects, providing utilities to
@@ -73,10 +118,17 @@ class ShotList(object):
         A ShotList is a list of 2D Numpy arrays.
         '''
         self.shots = []
+        # ShotSampler objects, cached until the shots or weights change
+        self.samplers = {}
         if shots is not None:
             assert all([isinstance(shot, Shot) for shot in shots])
             self.shots = [shot for shot in shots]
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('samplers', None)
+        return state
+
     def load_from_shot_list_files_object(self, shot_list_files_object,
                                          signals):
         machine = shot_list_files_object.machine
@@ -145,6 +197,34 @@ class ShotList(object):
         assert len(weights) == len(self.shots)
         for (i, w) in enumerate(weights):
             self.shots[i].weight = w
+        self.invalidate_samplers()
+
+    def invalidate_samplers(self):
+        self.samplers = {}
+
+    def get_sampler(self, kind):
+        '''Cached ShotSampler drawing shots by difficulty weight
+        ('weighted'), with balanced classes ('equal_classes'), or from a
+        single class ('disruptive' or 'non_disruptive')'''
+        # ShotLists pickled by older versions have no samplers
+        if getattr(self, 'samplers', None) is None:
+            self.samplers = {}
+        if kind not in self.samplers:
+            if kind == 'weighted':
+                p = [shot.weight for shot in self.shots]
+            else:
+                if kind == 'equal_classes':
+                    weights_d, weights_nd = self.get_weights_d_nd()
+                elif kind == 'disruptive':
+                    weights_d, weights_nd = 1.0, 0.0
+                else:
+                    assert kind == 'non_disruptive', (
+                        'unknown sampler {}'.format(kind))
+                    weights_d, weights_nd = 0.0, 1.0
+                p = [weights_d if shot.is_disruptive_shot()
+                     else weights_nd for shot in self.shots]
+            self.samplers[kind] = ShotSampler(self.shots, p)
+        return self.samplers[kind]
 
     def sample_weighted_given_arr(self, p):
         p = p/np.sum(p)
@@ -155,25 +235,15 @@ class ShotList(object):
         idx = np.random.choice(range(len(self.shots)))
         return self.shots[idx]
 
-    def sample_weighted(self):
-        p = np.array([shot.weight for shot in self.shots])
-        return self.sample_weighted_given_arr(p)
+    def sample_weighted(self, size=None):
+        return self.get_sampler('weighted').sample(size)
 
-    def sample_single_class(self, disruptive):
-        weights_d = 0.0
-        weights_nd = 1.0
-        if disruptive:
-            weights_d = 1.0
-            weights_nd = 0.0
-        p = np.array([weights_d if shot.is_disruptive_shot()
-                      else weights_nd for shot in self.shots])
-        return self.sample_weighted_given_arr(p)
+    def sample_single_class(self, disruptive, size=None):
+        kind = 'disruptive' if disruptive else 'non_disruptive'
+        return self.get_sampler(kind).sample(size)
 
-    def sample_equal_classes(self):
-        weights_d, weights_nd = self.get_weights_d_nd()
-        p = np.array([weights_d if shot.is_disruptive_shot()
-                      else weights_nd for shot in self.shots])
-        return self.sample_weighted_given_arr(p)
+    def sample_equal_classes(self, size=None):
+        return self.get_sampler('equal_classes').sample(size)
 
     def get_weights_d_nd(self):
         # TODO(KGF): only called in above sample_equal_classes()
@@ -190,7 +260,11 @@ class ShotList(object):
         return weights_d/max_weight, weights_nd/max_weight
 
     def num_timesteps(self, prepath):
-        ls = [shot.num_timesteps(prepath) for shot in self.shots]
+        metadata = ShotMetadataIndex(prepath)
+        ls = [metadata.get_length(shot) for shot in self.shots]
+        # fall back to the shot files for shots missing from the index
+        ls = [ts if ts is not None else shot.num_timesteps(prepath)
+              for (shot, ts) in zip(self.shots, ls)]
         timesteps_total = sum(ls)
         timesteps_d = sum([ts for (i, ts) in enumerate(
             ls) if self.shots[i].is_disruptive_shot()])
@@ -249,11 +323,13 @@ class ShotList(object):
     def append(self, shot):
         assert isinstance(shot, Shot)
         self.shots.append(shot)
+        self.invalidate_samplers()
 
     def remove(self, shot):
         assert shot in self.shots
         self.shots.remove(shot)
         assert shot not in self.shots
+        self.invalidate_samplers()
 
     def make_light(self):
         for shot in self.shots:
@@ -268,6 +344,80 @@ class ShotList(object):
             return False
 
 
+class ShotMetadataIndex(object):
+    '''
+    A sidecar index of per-shot metadata for a processed_prepath.
+
+    Records are keyed by Shot.get_id_str() and hold the processed length,
+    valid, is_disruptive, t_disrupt and per-signal availability, so that
+    ShotList queries and the preprocessing skip check never need to open
+    the individual shot files. The index is written during preprocessing,
+    together with the shot files it describes.
+    '''
+    filename = 'shot_metadata.npz'
+
+    def __init__(self, prepath):
+        self.prepath = prepath
+        self.records = {}
+        if os.path.isfile(self.get_path()):
+            dat = np.load(self.get_path(), encoding="latin1",
+                          allow_pickle=True)
+            self.records = dat['records'][()]
+
+    def get_path(self):
+        return os.path.join(self.prepath, self.filename)
+
+    @staticmethod
+    def make_record(shot, input_hash=None):
+        signals_available = getattr(shot, 'signals_available', None)
+        return {'length': 0 if shot.ttd is None else len(shot.ttd),
+                'valid': bool(shot.valid),
+                'is_disruptive': bool(shot.is_disruptive),
+                't_disrupt': shot.t_disrupt,
+                'signals_available': signals_available,
+                'input_hash': input_hash}
+
+    def is_up_to_date(self, shot, input_hash):
+        record = self.get(shot)
+        return (record is not None
+                and record.get('input_hash') == input_hash)
+
+    def __contains__(self, shot):
+        return shot.get_id_str() in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    def get(self, shot):
+        return self.records.get(shot.get_id_str())
+
+    def get_length(self, shot):
+        record = self.get(shot)
+        return None if record is None else record['length']
+
+    def update(self, shot, record=None):
+        if record is None:
+            record = ShotMetadataIndex.make_record(shot)
+        self.records[shot.get_id_str()] = record
+
+    def remove(self, shot):
+        self.records.pop(shot.get_id_str(), None)
+
+    def restore(self, shot):
+        '''Equivalent of shot.restore(prepath, light=True)'''
+        record = self.get(shot)
+        shot.valid = record['valid']
+        shot.is_disruptive = record['is_disruptive']
+        shot.make_light()
+
+    def save(self):
+        makedirs_process_safe(self.prepath)
+        tmp_path = self.get_path() + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, records=self.records)
+        os.rename(tmp_path, self.get_path())
+
+
 class Shot(object):
     '''
     A class representing a shot.
@@ -306,6 +456,7 @@ class Shot(object):
         self.t_disrupt = t_disrupt
         self.weight = 1.0
         self.augmentation_fn = None
+        self.signals_available = None
         if t_disrupt is not None:
             self.is_disruptive = Shot.is_disruptive_given_disruption_time(
                 t_disrupt)
@@ -343,6 +494,37 @@ class Shot(object):
         self.make_light()
         return ts
 
+    def get_raw_file_stats(self, conf):
+        '''(path, mtime, size) of the raw signal files of this shot'''
+        signal_prepaths = conf['paths']['signal_prepath']
+        if not isinstance(signal_prepaths, list):
+            signal_prepaths = [signal_prepaths]
+        file_stats = []
+        for signal in self.signals:
+            for prepath in signal_prepaths:
+                file_path = signal.get_file_path(prepath, self.machine,
+                                                 self.number)
+                if os.path.isfile(file_path):
+                    stat = os.stat(file_path)
+                    file_stats.append((file_path, stat.st_mtime,
+                                       stat.st_size))
+        return file_stats
+
+    def get_input_hash(self, conf, file_stats=None):
+        '''
+        Provenance hash of everything preprocess() depends on: the raw
+        signal files (by path, mtime and size), the signal set and the
+        resampling and filtering parameters.
+        '''
+        if file_stats is None:
+            file_stats = self.get_raw_file_stats(conf)
+        items = [conf['data']['dt'], conf['data']['T_max'],
+                 conf['data']['T_min_warn'], conf['model']['length'],
+                 conf['data']['floatx'], self.t_disrupt]
+        items += [signal.description_plus_paths() for signal in self.signals]
+        items += file_stats
+        return myhash(str(items))
+
     def get_number(self):
         return self.number
 
@@ -397,6 +579,7 @@ class Shot(object):
         if conf['paths']['data'] == 'd3d_data_garbage':
             garbage = True
         invalid_signals = 0
+        self.signals_available = {}
         signal_prepath = conf['paths']['signal_prepath']
         # TODO(KGF): check the purpose of the following D3D-specific lines
         # added from fork in Dec 2019. Add [omit] print?
@@ -413,6 +596,7 @@ class Shot(object):
             else:
                 t, sig, valid_signal = signal.load_data(
                     signal_prepath, self, conf['data']['floatx'])
+            self.signals_available[signal.description] = bool(valid_signal)
             if not valid_signal:
                 # TODO(KGF): new check added from fork in Dec 2019.
                 # Add [omit] print?
@@ -451,6 +635,7 @@ class Shot(object):
                             # peeking into possible disruptions from this early
                             # terminated channel
                             invalid_signals += 1
+                            self.signals_available[signal.description] = False
                             t = np.arange(0, 20, 0.001)
                             sig = np.zeros((t.shape[0], sig.shape[1]))
                     else:
@@ -487,17 +672,14 @@ class Shot(object):
     def cut_and_resample_signals(self, time_arrays, signal_arrays, t_min,
                                  t_max, conf):
         dt = conf['data']['dt']
-        signals_dict = dict()
 
         # resample signals
         assert len(signal_arrays) == len(time_arrays) == len(self.signals)
         assert len(signal_arrays) > 0
-        t_resampled = 0
-        for (i, signal) in enumerate(self.signals):
-            t_resampled, sigr = cut_and_resample_signal(
-                time_arrays[i], signal_arrays[i], t_min, t_max, dt,
-                conf['data']['floatx'])
-            signals_dict[signal] = sigr
+        t_resampled, signals_resampled = cut_and_resample_signals(
+            time_arrays, signal_arrays, t_min, t_max, dt,
+            conf['data']['floatx'])
+        signals_dict = dict(zip(self.signals, signals_resampled))
 
         ttd = self.convert_to_ttd(t_resampled, conf)
         self.signals_dict = signals_dict
@@ -555,6 +737,7 @@ class Shot(object):
     def make_light(self):
         self.signals_dict = None
         self.ttd = None
+        self.signals_available = None
 
     @staticmethod
     def is_disruptive_given_disruption_time(t):
@@ -33,6 +33,92 @@ def get_missing_value_array():
     return np.array([-1.0])
 
 
+def save_raw_signal(save_path, data):
+    """Save a raw shot signal array in the binary .npy format.
+
+    The layout is identical to the legacy .txt files: the first column holds
+    the time and the remaining columns the signal (or the mapping, followed by
+    the signal, for profile signals).
+    """
+    tmp_path = save_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, np.asarray(data))
+    # atomic rename, so that concurrent readers never see a partial file
+    os.rename(tmp_path, save_path)
+
+
+def load_raw_signal(file_path, dtype='float32'):
+    """Load a raw shot signal from a binary .npy or a legacy .txt file"""
+    if file_path.endswith('.npy'):
+        data = np.load(file_path, mmap_mode='r')
+        if data.dtype == np.dtype(dtype):
+            return data
+        return data.astype(dtype)
+    return np.loadtxt(file_path, dtype=dtype)
+
+
+def convert_raw_signal_file(txt_path, remove_txt=False):
+    """Convert a single legacy .txt raw signal file to the binary format.
+
+    Returns one of 'converted', 'skipped' (binary file already up to date or
+    empty text file) or 'failed'.
+    """
+    npy_path = txt_path[:-len('.txt')] + '.npy'
+    if (os.path.isfile(npy_path)
+            and os.path.getmtime(npy_path) >= os.path.getmtime(txt_path)):
+        status = 'skipped'
+    elif os.path.getsize(txt_path) == 0:
+        # leave empty files alone; they are reported and removed on loading
+        return 'skipped'
+    else:
+        try:
+            data = np.loadtxt(txt_path)
+        except Exception as e:
+            print('Cannot convert {}: {}'.format(txt_path, e))
+            return 'failed'
+        save_raw_signal(npy_path, data)
+        status = 'converted'
+    if remove_txt:
+        os.remove(txt_path)
+    return status
+
+
+def get_raw_signal_txt_files(prepath):
+    """Return all legacy raw signal files (named <shot number>.txt)"""
+    paths = []
+    for dirpath, _, filenames in os.walk(prepath):
+        for f in filenames:
+            if f.endswith('.txt') and f[:-len('.txt')].isdigit():
+                paths.append(os.path.join(dirpath, f))
+    return paths
+
+
+def convert_raw_signal_tree(prepath, num_processes=None, remove_txt=False):
+    """Migrate a signal_prepath tree of .txt raw signals to .npy in parallel"""
+    start_time = time.time()
+    paths = get_raw_signal_txt_files(prepath)
+    if num_processes is None:
+        num_processes = max(1, mp.cpu_count() - 2)
+    print('Converting {} raw signal files under {} on {} processes'.format(
+        len(paths), prepath, num_processes))
+    counts = {'converted': 0, 'skipped': 0, 'failed': 0}
+    fn = partial(convert_raw_signal_file, remove_txt=remove_txt)
+    pool = mp.Pool(num_processes)
+    for (i, status) in enumerate(pool.imap_unordered(fn, paths,
+                                                     chunksize=64)):
+        counts[status] += 1
+        if i % 1000 == 0:
+            sys.stdout.write('\r{}/{}'.format(i, len(paths)))
+            sys.stdout.flush()
+    pool.close()
+    pool.join()
+    print('\nFinished converting in {:.2f} seconds: '.format(
+        time.time() - start_time)
+          + '{converted} converted, {skipped} skipped, {failed} failed'.format(
+              **counts))
+    return counts
+
+
 def makedirs_process_safe(dirpath):
     try:  # can lead to race condition
         os.makedirs(dirpath)
@@ -82,6 +168,7 @@ def save_shot(shot_num_queue, c, signals, save_prepath, machine, sentinel=-1):
         shot_complete = True
         for signal in signals:
             signal_path = signal.get_path(machine)
+            # existing shot files may be in either the binary or .txt format
             save_path_full = signal.get_file_path(save_prepath, machine,
                                                   shot_num)
             success = False
@@ -120,12 +207,14 @@ def save_shot(shot_num_queue, c, signals, save_prepath, machine, sentinel=-1):
                                                            ).transpose()
                             data_two_column = np.vstack(
                                 (mapping_two_column, data_two_column))
+                    save_path_full = signal.get_file_path(
+                        save_prepath, machine, shot_num, ext='.npy')
                     makedirdepth_process_safe(save_path_full)
                     if success:
-                        np.savetxt(save_path_full, data_two_column, fmt='%.5e')
+                        save_raw_signal(save_path_full, data_two_column)
                     else:
-                        np.savetxt(save_path_full, get_missing_value_array(),
-                                   fmt='%.5e')
+                        save_raw_signal(save_path_full,
+                                        get_missing_value_array())
                     print('.', end='')
                 except BaseException:
                     print('Could not save shot {}, signal {}'.format(
@@ -12,6 +12,7 @@ from __future__ import print_function
 import itertools
 import os
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 # from scipy.interpolate import UnivariateSpline
 
 # interpolate in a way that doesn't use future information.
@@ -25,25 +26,40 @@ def time_sensitive_interp(x, t, t_new):
     return x[indices]
 
 
-def resample_signal(t, sig, tmin, tmax, dt, precision_str='float32'):
+def get_resample_indices(t, t_new, tmin=-np.inf, tmax=np.inf):
+    """Map every point of t_new onto the latest sample of t at or before it.
+
+    Only samples with tmin <= t <= tmax are considered. Returns the gather
+    indices into the (unsorted) array t, together with the sorted and cut
+    time array. Computing the map once lets all channels of a signal, and all
+    signals sharing a time base, be resampled with a single fancy-index.
+    """
     order = np.argsort(t)
     t = t[order]
-    sig = sig[order, :]
-    sig_width = sig.shape[1]
-    tt = np.arange(tmin, tmax, dt, dtype=precision_str)
-    sig_interp = np.zeros((len(tt), sig_width), dtype=precision_str)
-    for i in range(sig_width):
-        # make sure to not use future information
-        sig_interp[:, i] = time_sensitive_interp(sig[:, i], t, tt)
-        # f = UnivariateSpline(t,sig[:,i],s=0,k=1,ext=0)
-        # sig_interp[:,i] = f(tt)
-    if(np.any(np.isnan(sig_interp))):
+    lo = np.searchsorted(t, tmin, side='left')
+    hi = np.searchsorted(t, tmax, side='right')
+    t = t[lo:hi]
+    # make sure to not use future information
+    indices = np.maximum(0, np.searchsorted(t, t_new, side='right')-1)
+    return order[lo + indices], t
+
+
+def check_resampled_signal(t, sig_interp):
+    if np.any(np.isnan(sig_interp)):
         print("signal contains nan")
-    if(np.any(t[1:] - t[:-1] <= 0)):
+    if np.any(t[1:] - t[:-1] <= 0):
         print("non increasing")
         idx = np.where(t[1:] - t[:-1] <= 0)[0][0]
         print(t[idx-10:idx+10])
 
+
+def resample_signal(t, sig, tmin, tmax, dt, precision_str='float32'):
+    tt = np.arange(tmin, tmax, dt, dtype=precision_str)
+    indices, t = get_resample_indices(t, tt)
+    sig_interp = sig[indices].astype(precision_str, copy=False)
+    # f = UnivariateSpline(t,sig[:,i],s=0,k=1,ext=0)
+    # sig_interp[:,i] = f(tt)
+    check_resampled_signal(t, sig_interp)
     return tt, sig_interp
 
 
@@ -57,6 +73,102 @@ def cut_and_resample_signal(t, sig, tmin, tmax, dt, precision_str):
     return resample_signal(t, sig, tmin, tmax, dt, precision_str)
 
 
+def cut_and_resample_signals(time_arrays, signal_arrays, tmin, tmax, dt,
+                             precision_str='float32'):
+    """Batched cut_and_resample_signal() for all signals of a shot.
+
+    The common time grid is built once, and the index map is only recomputed
+    for signals whose time base differs from one already seen.
+    """
+    assert len(time_arrays) == len(signal_arrays)
+    tt = np.arange(tmin, tmax, dt, dtype=precision_str)
+    seen_times = []
+    seen_maps = []
+    signals_resampled = []
+    for t, sig in zip(time_arrays, signal_arrays):
+        index_map = None
+        for (j, t_seen) in enumerate(seen_times):
+            if t is t_seen or np.array_equal(t, t_seen):
+                index_map = seen_maps[j]
+                break
+        if index_map is None:
+            index_map = get_resample_indices(t, tt, tmin, tmax)
+            seen_times.append(t)
+            seen_maps.append(index_map)
+        indices, t_cut = index_map
+        sig_interp = sig[indices].astype(precision_str, copy=False)
+        check_resampled_signal(t_cut, sig_interp)
+        signals_resampled.append(sig_interp)
+    return tt, signals_resampled
+
+
+def remap_profiles(mapping, sig, remapping):
+    """Piecewise-linearly remap every row of a profile onto new coordinates.
+
+    Row i of sig is sampled at the coordinates mapping[i, :]. Each row is
+    sorted and deduplicated (keeping the first occurrence, like np.unique)
+    and interpolated at remapping, holding the boundary values outside of
+    the sampled range. This is the same as evaluating
+    UnivariateSpline(x, y, s=0, k=1, ext=3) row by row, but done for all
+    rows in one vectorized pass.
+
+    Returns the (rows, len(remapping)) remapped array and a boolean mask of
+    the rows that had enough (> 2) unique points to be interpolated. Invalid
+    rows are set to zero.
+    """
+    mapping = np.asarray(mapping, dtype=np.float64)
+    sig = np.asarray(sig, dtype=np.float64)
+    remapping = np.asarray(remapping, dtype=np.float64)
+    assert mapping.shape == sig.shape
+    # stable sort, so the first of several equal coordinates comes first
+    order = np.argsort(mapping, axis=1, kind='stable')
+    xs = np.take_along_axis(mapping, order, axis=1)
+    ys = np.take_along_axis(sig, order, axis=1)
+    # push duplicate coordinates to the end of each row
+    duplicate = np.zeros(xs.shape, dtype=bool)
+    duplicate[:, 1:] = xs[:, 1:] == xs[:, :-1]
+    xs[duplicate] = np.inf
+    order = np.argsort(xs, axis=1, kind='stable')
+    xs = np.take_along_axis(xs, order, axis=1)
+    ys = np.take_along_axis(ys, order, axis=1)
+    num_unique = xs.shape[1] - np.sum(duplicate, axis=1)
+    valid = num_unique > 2
+
+    # left end of the interval containing each query point
+    lower = np.sum(xs[:, None, :] <= remapping[None, :, None], axis=2) - 1
+    lower = np.clip(lower, 0, np.maximum(num_unique - 2, 0)[:, None])
+    upper = np.minimum(lower + 1, xs.shape[1] - 1)
+    x0 = np.take_along_axis(xs, lower, axis=1)
+    x1 = np.take_along_axis(xs, upper, axis=1)
+    y0 = np.take_along_axis(ys, lower, axis=1)
+    y1 = np.take_along_axis(ys, upper, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # clipping the weights holds the boundary values (ext=3)
+        weights = np.clip((remapping[None, :] - x0)/(x1 - x0), 0.0, 1.0)
+        sig_remapped = y0 + weights*(y1 - y0)
+    sig_remapped[~valid, :] = 0.0
+    return sig_remapped, valid
+
+
+def correlate_valid(arr, window):
+    """Correlate every column of arr with window, keeping only the output
+    computed without zero-padding, like scipy.signal.correlate(..., 'valid').
+
+    Output row k is sum_j arr[k + j, :]*window[j], so it only depends on
+    rows up to k + len(window) - 1 of the input. All columns are done in a
+    single contraction over a strided (zero-copy) view of the sliding
+    windows, instead of one correlation per column.
+    """
+    window = np.asarray(window)
+    arr = np.asarray(arr)
+    num_taps = len(window)
+    num_rows = max(0, arr.shape[0] - num_taps + 1)
+    windows = as_strided(arr, shape=(num_rows, num_taps) + arr.shape[1:],
+                         strides=(arr.strides[0],) + arr.strides,
+                         writeable=False)
+    return np.einsum('j,kj...->k...', window, windows)
+
+
 def get_individual_shot_file(prepath, machine, shot_num, raw_signal=False,
                              ext='.txt'):
     """Return filepath of raw input .txt shot signal or processed .npz shot"""
@@ -66,6 +178,23 @@ def get_individual_shot_file(prepath, machine, shot_num, raw_signal=False,
         return os.path.join(prepath, str(machine) + '_' + str(shot_num) + ext)
 
 
+def get_raw_signal_file(prepath, machine, shot_num, ext=None):
+    """Return filepath of a raw input shot signal.
+
+    If ext is None, the binary .npy file is returned when it exists, falling
+    back to the legacy .txt file otherwise.
+    """
+    if ext is not None:
+        return get_individual_shot_file(prepath, machine, shot_num,
+                                        raw_signal=True, ext=ext)
+    binary_path = get_individual_shot_file(prepath, machine, shot_num,
+                                           raw_signal=True, ext='.npy')
+    if os.path.isfile(binary_path):
+        return binary_path
+    return get_individual_shot_file(prepath, machine, shot_num,
+                                    raw_signal=True, ext='.txt')
+
+
 def append_to_filename(path, to_append):
     ending_idx = path.rfind('.')
     new_path = path[:ending_idx] + to_append + path[ending_idx:]
@@ -0,0 +1,147 @@
+'''
+#########################################################
+This file contains bounded-memory, mergeable streaming statistics used to
+train the normalizers on many shots, possibly in parallel: exact column-wise
+running moments and an approximate column-wise quantile sketch.
+#########################################################
+'''
+
+from __future__ import print_function, division
+import numpy as np
+
+
+class RunningMoments(object):
+    '''
+    Exact column-wise count, mean and variance of a stream of rows.
+
+    Batches of rows and partial results from other workers are combined
+    with the pairwise update of Chan et al., which is numerically stable
+    and independent of the order of the updates.
+    '''
+
+    def __init__(self, num_columns=None):
+        self.count = 0
+        self.mean = None if num_columns is None else np.zeros(num_columns)
+        self.m2 = None if num_columns is None else np.zeros(num_columns)
+
+    def update(self, rows):
+        rows = np.atleast_2d(np.asarray(rows, dtype=np.float64))
+        if rows.shape[0] == 0:
+            return
+        other = RunningMoments()
+        other.count = rows.shape[0]
+        other.mean = np.mean(rows, axis=0)
+        other.m2 = np.sum((rows - other.mean)**2, axis=0)
+        self.merge(other)
+
+    def merge(self, other):
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.count = other.count
+            self.mean = np.array(other.mean, dtype=np.float64)
+            self.m2 = np.array(other.m2, dtype=np.float64)
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta*other.count/count
+        self.m2 = self.m2 + other.m2 + delta**2*self.count*other.count/count
+        self.count = count
+
+    def var(self):
+        return self.m2/max(self.count, 1)
+
+    def std(self):
+        return np.sqrt(self.var())
+
+
+class QuantileSketch(object):
+    '''
+    Approximate column-wise quantiles of a stream of rows in bounded memory.
+
+    A mergeable compactor sketch in the style of KLL: rows enter level 0,
+    and whenever a level holds more than k rows, each of its columns is
+    sorted and every other value (with a random offset) is promoted to the
+    next level, where it counts twice as much. Memory is O(k log(n/k)) per
+    column and the rank error is O(log(n/k)/k). Until the first compaction
+    (n <= k) all rows are kept and quantiles are exact, i.e. identical to
+    np.quantile(rows, q, axis=0).
+    '''
+
+    def __init__(self, k=256, seed=0):
+        self.k = k
+        self.count = 0
+        self.levels = []
+        self.rng = np.random.RandomState(seed)
+
+    @classmethod
+    def from_rows(cls, rows, k=256, seed=0):
+        sketch = cls(k, seed)
+        sketch.update(rows)
+        return sketch
+
+    def update(self, rows):
+        rows = np.atleast_2d(np.asarray(rows, dtype=np.float64))
+        if rows.shape[0] == 0:
+            return
+        self.add_to_level(0, rows)
+        self.count += rows.shape[0]
+        self.compress()
+
+    def merge(self, other):
+        for (level, rows) in enumerate(other.levels):
+            if rows is not None:
+                self.add_to_level(level, rows)
+        self.count += other.count
+        self.compress()
+
+    def add_to_level(self, level, rows):
+        while len(self.levels) <= level:
+            self.levels.append(None)
+        if self.levels[level] is None:
+            self.levels[level] = rows
+        else:
+            self.levels[level] = np.concatenate((self.levels[level], rows),
+                                                axis=0)
+
+    def compress(self):
+        level = 0
+        while level < len(self.levels):
+            rows = self.levels[level]
+            if rows is not None and rows.shape[0] > self.k:
+                rows = np.sort(rows, axis=0)
+                # an odd row out stays behind at this level
+                num_kept = rows.shape[0] % 2
+                self.levels[level] = rows[-1:] if num_kept else None
+                rows = rows[:rows.shape[0] - num_kept]
+                offset = self.rng.randint(2)
+                self.add_to_level(level + 1, rows[offset::2])
+            level += 1
+
+    def is_exact(self):
+        return len(self.levels) <= 1
+
+    def quantile(self, q):
+        assert self.count > 0, 'quantile of an empty sketch'
+        if self.is_exact():
+            return np.quantile(self.levels[0], q, axis=0)
+        values = []
+        weights = []
+        for (level, rows) in enumerate(self.levels):
+            if rows is not None:
+                values.append(rows)
+                weights.append(np.full(rows.shape[0], 2.0**level))
+        values = np.concatenate(values, axis=0)
+        weights = np.concatenate(weights)
+        order = np.argsort(values, axis=0)
+        cum_weights = np.cumsum(weights[order], axis=0)
+        idx = np.sum(cum_weights < q*cum_weights[-1], axis=0)
+        return np.take_along_axis(
+            np.take_along_axis(values, order, axis=0), idx[None, :],
+            axis=0)[0]
+
+    def median(self):
+        return self.quantile(0.5)
+
+    def nbytes(self):
+        return sum([rows.nbytes for rows in self.levels if rows is not None])
@@ -0,0 +1,47 @@
+import os
+import shutil
+import tempfile
+import types
+import unittest
+
+import numpy as np
+
+try:
+    from plasma.preprocessor.normalize import MeanVarNormalizer
+except ImportError:
+    MeanVarNormalizer = None
+
+
+@unittest.skipIf(MeanVarNormalizer is None,
+                 'plasma.preprocessor.normalize cannot be imported')
+class TestLegacyStats(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.conf = {
+            'paths': {
+                'normalizer_path': os.path.join(self.directory,
+                                                'normalization.npz'),
+                'all_machines': ['test']},
+            'data': {'target': types.SimpleNamespace(remapper=None)}}
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_load_legacy_rows(self):
+        # one row of stats per shot, more rows than a default sketch keeps
+        rng = np.random.RandomState(0)
+        means = rng.lognormal(size=(5000, 3))
+        stds = rng.lognormal(size=(5000, 3))
+        np.savez(self.conf['paths']['normalizer_path'],
+                 means={'test': means}, stds={'test': stds},
+                 num_processed={'test': len(means)},
+                 num_disruptive={'test': 0}, machines={'test'})
+        normalizer = MeanVarNormalizer(self.conf)
+        normalizer.load_stats()
+        offsets, scales = normalizer.get_offsets_and_scales('test')
+        np.testing.assert_allclose(offsets, np.median(means, axis=0))
+        np.testing.assert_allclose(scales, np.median(stds, axis=0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import unittest
+
+import numpy as np
+
+try:
+    from mpi4py import MPI
+except ImportError:
+    MPI = None
+if MPI is not None:
+    from plasma.primitives.ops import (
+        GradientBuckets, HalfPrecisionCompressor, Float16Compressor,
+        BFloat16Compressor, TopKCompressor, HierarchicalAllreduce
+        )
+
+
+@unittest.skipIf(MPI is None, 'mpi4py is not installed')
+class TestGradientBuckets(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.arrays = [rng.randn(*shape).astype('float32') for shape in
+                       [(10, 20), (20,), (5, 5, 4), (1,), (3, 7)]]
+
+    def test_bucket_sizes(self):
+        buckets = GradientBuckets.from_arrays(self.arrays)
+        self.assertEqual(len(buckets.send_buffers), 1)
+        self.assertEqual(len(buckets.send_buffers[0]),
+                         sum([arr.size for arr in self.arrays]))
+        # 4 bytes per float32, at most 100 elements per bucket
+        buckets = GradientBuckets.from_arrays(self.arrays, 400)
+        self.assertEqual([len(b) for b in buckets.send_buffers],
+                         [200, 20, 100, 22])
+
+    def test_pack_allreduce_round_trip(self):
+        for bucket_nbytes in (None, 400, 8):
+            buckets = GradientBuckets.from_arrays(self.arrays, bucket_nbytes)
+            self.assertTrue(buckets.matches(self.arrays))
+            self.assertFalse(buckets.matches(self.arrays[:2]))
+            buckets.pack(self.arrays)
+            outputs = buckets.allreduce(MPI.COMM_WORLD)
+            num_workers = MPI.COMM_WORLD.Get_size()
+            buckets.average(num_workers)
+            for (out, arr) in zip(outputs, self.arrays):
+                self.assertEqual(out.shape, arr.shape)
+                self.assertEqual(out.dtype, arr.dtype)
+                np.testing.assert_allclose(out, arr, rtol=1e-6)
+
+    def test_zero(self):
+        buckets = GradientBuckets.from_arrays(self.arrays, 400)
+        buckets.pack(self.arrays)
+        buckets.zero()
+        for out in buckets.allreduce(MPI.COMM_WORLD):
+            self.assertFalse(np.any(out))
+
+
+@unittest.skipIf(MPI is None, 'mpi4py is not installed')
+class TestGradientCompressors(unittest.TestCase):
+    def setUp(self):
+        self.comm = MPI.COMM_WORLD
+        rng = np.random.RandomState(self.comm.Get_rank())
+        # not a flat buffer, e.g. the deltas of a single layer
+        self.send = rng.randn(37, 5).astype('float32')
+        self.exact = np.empty_like(self.send)
+        self.comm.Allreduce(self.send, self.exact, op=MPI.SUM)
+
+    def test_abstract(self):
+        self.assertRaises(TypeError, HalfPrecisionCompressor)
+
+    def test_half_precision(self):
+        num_workers = self.comm.Get_size()
+        for compressor in (Float16Compressor(), BFloat16Compressor()):
+            recv = np.empty_like(self.send)
+            compressor.allreduce(self.comm, self.send, recv)
+            self.assertEqual(recv.shape, self.send.shape)
+            np.testing.assert_allclose(recv, self.exact, rtol=1e-2,
+                                       atol=2e-2*num_workers)
+
+    def test_topk(self):
+        recv = np.empty_like(self.send)
+        TopKCompressor(1.0).allreduce(self.comm, self.send, recv)
+        np.testing.assert_allclose(recv, self.exact, rtol=1e-5, atol=1e-5)
+        compressor = TopKCompressor(0.1)
+        compressor.allreduce(self.comm, self.send, recv)
+        self.assertEqual(recv.shape, self.send.shape)
+        k = compressor.get_k(self.send.size)
+        self.assertLessEqual(np.count_nonzero(recv),
+                             k*self.comm.Get_size())
+        residual = compressor.residuals[0]
+        self.assertEqual(np.count_nonzero(residual), self.send.size - k)
+
+
+@unittest.skipIf(MPI is None, 'mpi4py is not installed')
+class TestHierarchicalAllreduce(unittest.TestCase):
+    def setUp(self):
+        self.comm = MPI.COMM_WORLD
+        self.reducer = HierarchicalAllreduce(self.comm)
+
+    def tearDown(self):
+        self.reducer.free()
+        self.assertEqual(self.reducer.windows, {})
+
+    def test_allreduce(self):
+        rng = np.random.RandomState(self.comm.Get_rank())
+        send = rng.randn(37, 5).astype('float32')
+        exact = np.empty_like(send)
+        self.comm.Allreduce(send, exact, op=MPI.SUM)
+        recv = np.empty_like(send)
+        for _ in range(2):
+            self.reducer.allreduce(self.comm, send, recv)
+            np.testing.assert_allclose(recv, exact, rtol=1e-5, atol=1e-5)
+
+    def test_bcast(self):
+        buff = np.full((3, 7), self.comm.Get_rank(), dtype='float32')
+        self.reducer.bcast(buff)
+        np.testing.assert_array_equal(buff, np.zeros((3, 7)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import pickle
+import unittest
+
+import numpy as np
+
+from plasma.primitives.shots import Shot, ShotList, ShotSampler
+
+
+def make_shot_list(num_disruptive, num_nondisruptive):
+    shots = []
+    for i in range(num_disruptive + num_nondisruptive):
+        shot = Shot(number=i, machine='test', signals=[],
+                    t_disrupt=1.0 if i < num_disruptive else -1.0)
+        shot.is_disruptive = i < num_disruptive
+        shots.append(shot)
+    return ShotList(shots)
+
+
+class TestShotSampler(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+
+    def test_frequencies(self):
+        weights = np.array([0.0, 1.0, 2.0, 3.0, 10.0, 0.5])
+        sampler = ShotSampler(list(range(len(weights))), weights)
+        num_samples = 200000
+        counts = np.bincount(sampler.sample_indices(num_samples),
+                             minlength=len(weights))
+        expected = num_samples*weights/np.sum(weights)
+        self.assertEqual(counts[0], 0)
+        # well within 5 standard deviations of the binomial counts
+        np.testing.assert_array_less(
+            np.abs(counts - expected), 5*np.sqrt(expected) + 1)
+
+    def test_sample(self):
+        sampler = ShotSampler(['a', 'b'], [0.0, 1.0])
+        self.assertEqual(sampler.sample(), 'b')
+        self.assertEqual(sampler.sample(3), ['b', 'b', 'b'])
+
+
+class TestShotListSampling(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+
+    def test_single_class(self):
+        shot_list = make_shot_list(3, 7)
+        for shot in shot_list.sample_single_class(True, 100):
+            self.assertTrue(shot.is_disruptive_shot())
+        for shot in shot_list.sample_single_class(False, 100):
+            self.assertFalse(shot.is_disruptive_shot())
+
+    def test_equal_classes(self):
+        shot_list = make_shot_list(10, 90)
+        shots = shot_list.sample_equal_classes(20000)
+        frac = np.mean([shot.is_disruptive_shot() for shot in shots])
+        self.assertAlmostEqual(frac, 0.5, delta=0.02)
+
+    def test_weights_invalidate_cache(self):
+        shot_list = make_shot_list(2, 2)
+        self.assertIn(shot_list.sample_weighted(), shot_list.shots)
+        shot_list.set_weights([0.0, 0.0, 1.0, 0.0])
+        for shot in shot_list.sample_weighted(10):
+            self.assertIs(shot, shot_list.shots[2])
+
+    def test_pickle_drops_samplers(self):
+        shot_list = make_shot_list(2, 2)
+        shot_list.sample_weighted()
+        restored = pickle.loads(pickle.dumps(shot_list))
+        self.assertNotIn('samplers', restored.__dict__)
+        self.assertIn(restored.sample_weighted(), restored.shots)
+
+
+if __name__ == '__main__':
+    unittest.main()
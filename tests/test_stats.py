@@ -0,0 +1,60 @@
+import unittest
+
+import numpy as np
+
+from plasma.utils.stats import RunningMoments, QuantileSketch
+
+
+class TestRunningMoments(unittest.TestCase):
+    def test_update_and_merge(self):
+        rng = np.random.RandomState(0)
+        rows = rng.randn(1000, 3)*[1.0, 10.0, 0.1] + [5.0, -2.0, 1e3]
+        first = RunningMoments()
+        for batch in np.array_split(rows[:600], 7):
+            first.update(batch)
+        second = RunningMoments(3)
+        second.update(rows[600:])
+        first.merge(second)
+        first.merge(RunningMoments())
+        self.assertEqual(first.count, 1000)
+        np.testing.assert_allclose(first.mean, np.mean(rows, axis=0))
+        np.testing.assert_allclose(first.var(), np.var(rows, axis=0))
+        np.testing.assert_allclose(first.std(), np.std(rows, axis=0))
+
+    def test_empty_update(self):
+        moments = RunningMoments()
+        moments.update(np.zeros((0, 2)))
+        self.assertEqual(moments.count, 0)
+
+
+class TestQuantileSketch(unittest.TestCase):
+    def test_exact_below_k(self):
+        rows = np.random.RandomState(0).randn(200, 4)
+        sketch = QuantileSketch.from_rows(rows[:50], k=256)
+        sketch.merge(QuantileSketch.from_rows(rows[50:], k=256))
+        self.assertTrue(sketch.is_exact())
+        for q in [0.0, 0.1, 0.5, 0.9, 1.0]:
+            np.testing.assert_allclose(sketch.quantile(q),
+                                       np.quantile(rows, q, axis=0))
+
+    def test_approximate_merge(self):
+        rng = np.random.RandomState(1)
+        rows = rng.randn(20000, 2)*[1.0, 100.0]
+        sketches = [QuantileSketch.from_rows(batch, k=128, seed=i)
+                    for (i, batch) in enumerate(np.array_split(rows, 10))]
+        sketch = sketches[0]
+        for other in sketches[1:]:
+            sketch.merge(other)
+        self.assertFalse(sketch.is_exact())
+        self.assertEqual(sketch.count, len(rows))
+        self.assertLess(sketch.nbytes(), rows.nbytes/10)
+        for q in [0.1, 0.5, 0.9]:
+            estimate = sketch.quantile(q)
+            # rank error of the estimate, as a fraction of the rows
+            ranks = np.mean(rows <= estimate, axis=0)
+            np.testing.assert_allclose(ranks, q, atol=0.03)
+        np.testing.assert_allclose(sketch.median(), sketch.quantile(0.5))
+
+
+if __name__ == '__main__':
+    unittest.main()